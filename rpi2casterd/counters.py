@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Valve actuation counters for rpi2casterd.
+
+The output drivers record the 32-bit mask of every combination sent;
+this takes a single deque append, so the valve write is not delayed.
+The masks are counted in batches later: identical masks are grouped
+first, so the per-bit work depends on the number of distinct
+combinations, not on the number of machine cycles."""
+
+from collections import Counter, deque
+import json
+import os
+import threading
+
+# fold the pending masks in add() if nobody has done it for so long
+MAX_PENDING = 1 << 16
+
+
+class ValveCounters:
+    """Per-valve actuation counters.
+    names: signal names for mask bits 0...31; other valves
+    (e.g. air and water) are counted by name with count()."""
+    def __init__(self, names):
+        self.names = list(names)
+        self.totals = Counter()
+        # appending and popping from a deque is thread-safe
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def add(self, mask):
+        """Record a combination sent to the valves"""
+        self.pending.append(mask)
+        if len(self.pending) > MAX_PENDING:
+            self.fold()
+
+    def count(self, name):
+        """Record a single actuation of a named valve"""
+        self.pending.append(name)
+
+    def fold(self):
+        """Count the pending actuations (call this periodically)"""
+        with self.lock:
+            batch = Counter(self.pending.popleft()
+                            for _ in range(len(self.pending)))
+            for item, times in batch.items():
+                if isinstance(item, str):
+                    self.totals[item] += times
+                    continue
+                for bit, name in enumerate(self.names):
+                    if item >> bit & 1:
+                        self.totals[name] += times
+
+    def get(self):
+        """Get the actuation counts by valve name"""
+        self.fold()
+        with self.lock:
+            return dict(self.totals)
+
+    def reset(self):
+        """Set all counts to zero"""
+        self.fold()
+        with self.lock:
+            self.totals.clear()
+
+    def load(self, path):
+        """Add the counts saved in a JSON file"""
+        with open(path, 'r') as counters_file:
+            saved = json.load(counters_file)
+        with self.lock:
+            self.totals.update({str(name): int(value)
+                                for name, value in saved.items()})
+
+    def save(self, path):
+        """Save the counts in a JSON file, replacing it atomically"""
+        counts = self.get()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = '{}.tmp'.format(path)
+        with open(temporary, 'w') as counters_file:
+            json.dump(counts, counters_file, indent=0, sort_keys=True)
+        os.replace(temporary, path)
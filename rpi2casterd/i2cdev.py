@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Linux i2c-dev backend for rpi2casterd.
+
+Talks to the /dev/i2c-N device directly with I2C_RDWR ioctl calls,
+without any wrapper library. Both MCP23017 chips are updated
+with a single system call."""
+
+from functools import reduce
+import ctypes
+import fcntl
+import os
+import stat
+
+from rpi2casterd.counters import ValveCounters
+
+# ioctl request number from linux/i2c-dev.h
+I2C_RDWR = 0x0707
+# Output latch registers for MCP23017 control
+OLATA, OLATB = 0x14, 0x15
+# Port direction registers for MCP23017 control
+IODIRA, IODIRB = 0x00, 0x01
+
+
+class I2CMessage(ctypes.Structure):
+    """struct i2c_msg from linux/i2c.h"""
+    _fields_ = [('addr', ctypes.c_uint16), ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class I2CTransfer(ctypes.Structure):
+    """struct i2c_rdwr_ioctl_data from linux/i2c-dev.h"""
+    _fields_ = [('msgs', ctypes.POINTER(I2CMessage)),
+                ('nmsgs', ctypes.c_uint32)]
+
+
+def write_transfer(fd, request, transfer):
+    """Stand-in for fcntl.ioctl with a regular file: append the messages
+    of an I2C_RDWR transfer as they would go to the bus,
+    i.e. the 7-bit address followed by the message data bytes"""
+    if request != I2C_RDWR:
+        raise OSError('Unsupported ioctl request: 0x{:04x}'.format(request))
+    data = bytearray()
+    for number in range(transfer.nmsgs):
+        message = transfer.msgs[number]
+        data.append(message.addr)
+        data.extend(message.buf[:message.len])
+    os.write(fd, data)
+    return 0
+
+
+class I2CDevOutput:
+    """i2c-dev ioctl-based output controller for rpi2caster.
+
+    The MCP23017 increments its register pointer after each byte
+    (IOCON.SEQOP=0 after power-on), so writing a register address
+    followed by two bytes sets both A and B ports of a chip.
+
+    If the device path points to a regular file instead of a character
+    device, the same transfer is passed to write_transfer, which appends
+    the messages to that file (for testing); another ioctl function
+    can be given as well."""
+    name = 'i2c-dev ioctl output'
+
+    def __init__(self, config, ioctl=None):
+        path = (config.get('i2c_device') or
+                '/dev/i2c-{}'.format(config['i2c_bus']))
+        self.fd = os.open(path, os.O_RDWR)
+        self.is_device = stat.S_ISCHR(os.fstat(self.fd).st_mode)
+        self.ioctl = ioctl or (fcntl.ioctl if self.is_device
+                               else write_transfer)
+        # preallocated message buffers: register address + A + B
+        self.buffers = ((ctypes.c_uint8 * 3)(), (ctypes.c_uint8 * 3)())
+        addresses = config['mcp0_address'], config['mcp1_address']
+        self.messages = (I2CMessage * 2)(
+            *(I2CMessage(addr=address, flags=0, len=3,
+                         buf=ctypes.cast(buffer,
+                                         ctypes.POINTER(ctypes.c_uint8)))
+              for address, buffer in zip(addresses, self.buffers)))
+        self.transfer = I2CTransfer(msgs=self.messages, nmsgs=2)
+        # initialize pins as outputs with low initial state
+        self._send(IODIRA, 0x00, 0x00, 0x00, 0x00)
+        self.valves_off()
+        # map signals to outputs
+        signal_mappings = config['signal_mappings']
+        valve1, valve2 = signal_mappings['valve1'], signal_mappings['valve2']
+        valve3, valve4 = signal_mappings['valve3'], signal_mappings['valve4']
+        signals = [*valve1, *valve2, *valve3, *valve4]
+        signal_numbers = [2 ** x for x in range(32)]
+        self.mapping = dict(zip(signals, signal_numbers))
+        # per-valve actuation counters
+        self.actuations = ValveCounters(signals)
+
+    def __str__(self):
+        return self.name
+
+    def _send(self, register, byte0, byte1, byte2, byte3):
+        """Write 4 bytes of data to all ports (A, B)
+        on all devices (0, 1) in a single I2C_RDWR transfer"""
+        mcp0, mcp1 = self.buffers
+        mcp0[0], mcp0[1], mcp0[2] = register, byte3, byte2
+        mcp1[0], mcp1[1], mcp1[2] = register, byte1, byte0
+        self.ioctl(self.fd, I2C_RDWR, self.transfer)
+
+    def valves_on(self, signals):
+        """Get the signals, transform them to numeric value and send
+        the bytes to i2c devices"""
+        if signals:
+            assignment = (self.mapping.get(sig, 0) for sig in signals)
+            number = reduce(lambda x, y: x | y, assignment)
+            # Split it to four bytes sent at once
+            byte0 = (number >> 24) & 0xff
+            byte1 = (number >> 16) & 0xff
+            byte2 = (number >> 8) & 0xff
+            byte3 = number & 0xff
+        else:
+            number = byte0 = byte1 = byte2 = byte3 = 0x00
+
+        self._send(OLATA, byte0, byte1, byte2, byte3)
+        self.actuations.add(number)
+
+    def valves_off(self):
+        """Turn off all the valves"""
+        self._send(OLATA, 0x00, 0x00, 0x00, 0x00)
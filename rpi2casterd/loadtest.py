@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Load testing harness for the rpi2casterd web API.
+
+Usage:
+    rpi2casterd-loadtest run [--url URL] [options]
+        replay a realistic traffic mix: a casting client streaming
+        /signals requests, several dashboards polling the status,
+        and occasional /config and /emergency_stop requests.
+        Without --url, a simulated daemon is started in a subprocess.
+
+    rpi2casterd-loadtest serve [--port PORT] [--rpm RPM]
+                               [--trace FILE [--speed SPEED]]
+        run the daemon with mock GPIOs, the simulated output driver
+        and a machine cycle sensor rotating at a given speed,
+        or replaying a recorded sensor/emergency stop trace.
+"""
+from collections import defaultdict
+from contextlib import suppress
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# GPIO numbers as in the default configuration file;
+# the simulated daemon must not touch the real daemon's files
+SIMULATION_CONFIG = dict(output_driver='simulation', status_file='',
+                         trace_file='', counters_file='',
+                         motor_start_gpio='5', motor_stop_gpio='6',
+                         water_gpio='13', sensor_gpio='17',
+                         ready_led_gpio='18', air_gpio='19',
+                         emergency_stop_gpio='22', reboot_gpio='23',
+                         shutdown_gpio='24', working_led_gpio='25',
+                         error_led_gpio='26', mode_detect_gpio='27')
+SIGNALS = ['0005', '0075', 'S', *'ABCDEFGHIJKLMN',
+           *(str(x) for x in range(1, 15))]
+
+
+def serve(args):
+    """Run the daemon with a simulated machine"""
+    def rotate():
+        """Toggle the cycle sensor like a machine running at args.rpm"""
+        period = 60.0 / args.rpm
+        while not stopped.is_set():
+            sensor.drive_high()
+            time.sleep(period / 2)
+            sensor.drive_low()
+            time.sleep(period / 2)
+
+    # mock GPIOs must be selected before gpiozero creates any device
+    os.environ['GPIOZERO_PIN_FACTORY'] = 'mock'
+    from rpi2casterd import main as daemon
+    from rpi2casterd import traces
+    address = '127.0.0.1:{}'.format(args.port)
+    daemon.CFG.read_dict({'DEFAULT': dict(SIMULATION_CONFIG,
+                                          listen_address=address)})
+    daemon.journald_setup()
+    interface, player, stopped = None, None, threading.Event()
+    daemon.GPIO.initialize()
+    try:
+        if not args.punching:
+            # grounded mode detection input means casting
+            daemon.GPIO.mode_detect.pin.drive_low()
+        sensor = daemon.GPIO.sensor.pin
+        if args.trace:
+            pins = {traces.SENSOR: sensor,
+                    traces.EMERGENCY_STOP: daemon.GPIO.estop_button.pin}
+            player = traces.TracePlayer(args.trace, pins, speed=args.speed,
+                                        loop=True)
+            player.start()
+        else:
+            threading.Thread(target=rotate, daemon=True).start()
+        daemon.daemon_setup()
+        interface = daemon.Interface()
+        daemon.GPIO.ready_led.on()
+        interface.webapi()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        if player:
+            player.stop()
+        with suppress(AttributeError):
+            interface.machine_control(False)
+        daemon.GPIO.cleanup()
+
+
+class LoadGenerator:
+    """Concurrent HTTP clients with latency statistics"""
+    def __init__(self, url, timeout=30):
+        self.url, self.timeout = url.rstrip('/'), timeout
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def request(self, method, endpoint, data=None, record=True):
+        """Send a JSON request, record its latency and return the reply"""
+        body = None if data is None else json.dumps(data).encode()
+        req = urllib.request.Request(self.url + endpoint, data=body,
+                                     method=method)
+        if body is not None:
+            # a JSON content type with no body is a bad request
+            req.add_header('Content-Type', 'application/json')
+        key = '{} {}'.format(method, endpoint)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as rsp:
+                content = rsp.read()
+        except (urllib.error.URLError, OSError):
+            with self.lock:
+                self.errors[key] += 1
+            return None
+        duration = time.perf_counter() - start
+        if record:
+            with self.lock:
+                self.latencies[key].append(duration)
+        with suppress(ValueError):
+            return json.loads(content.decode())
+
+    def caster(self, cycles):
+        """Casting client: start the machine, stream the combinations"""
+        self.request('PUT', '/machine', record=False)
+        for _ in range(cycles):
+            combination = random.sample(SIGNALS, random.randint(1, 3))
+            reply = self.request('PUT', '/signals',
+                                 dict(signals=combination))
+            if reply and not reply.get('success'):
+                with self.lock:
+                    self.errors['PUT /signals'] += 1
+        self.request('DELETE', '/machine', record=False)
+        self.done.set()
+
+    def poller(self, method, endpoint, interval):
+        """Dashboard: repeat a request at a given interval"""
+        while not self.done.wait(interval * random.uniform(0.8, 1.2)):
+            self.request(method, endpoint)
+
+    def run(self, cycles, dashboards, status_interval, config_interval):
+        """Run the traffic mix, return the total duration"""
+        pollers = [('GET', '/', status_interval)] * dashboards
+        pollers.extend([('GET', '/config', config_interval),
+                        ('GET', '/emergency_stop', config_interval)])
+        threads = [threading.Thread(target=self.poller, args=x, daemon=True)
+                   for x in pollers]
+        threads.append(threading.Thread(target=self.caster, args=(cycles,)))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted sequence"""
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def analyze_cycles(csv_text, max_delay):
+    """Find disturbed cycles in the profiler data:
+    late valve writes after the sensor went ON (over max_delay seconds)
+    and missed machine revolutions."""
+    rows = [[int(x) for x in line.split(',')]
+            for line in csv_text.splitlines()[1:] if line]
+    # columns: cycle, request, parsed, sensor_on, valves_on, ...
+    cast = [row for row in rows if row[3] and row[4]]
+    late = [row[0] for row in cast if (row[4] - row[3]) / 1e9 > max_delay]
+    gaps = sorted(b[3] - a[3] for a, b in zip(cast, cast[1:]))
+    missed = []
+    if gaps:
+        median = gaps[len(gaps) // 2]
+        missed = [b[0] for a, b in zip(cast, cast[1:])
+                  if b[3] - a[3] > 1.5 * median]
+    return len(cast), late, missed
+
+
+def report(generator, duration, cycles_info):
+    """Print the load test results"""
+    print('Duration: {:.1f}s'.format(duration))
+    line = '{:<22}{:>7}{:>9}{:>10}{:>10}{:>10}{:>10}{:>8}'
+    print(line.format('endpoint', 'count', 'req/s', 'p50 ms', 'p95 ms',
+                      'p99 ms', 'max ms', 'errors'))
+    for key in sorted(set(generator.latencies) | set(generator.errors)):
+        values = sorted(generator.latencies.get(key, [])) or [0]
+        stats = ['{:.1f}'.format(percentile(values, f) * 1000)
+                 for f in (0.5, 0.95, 0.99, 1)]
+        count = len(generator.latencies.get(key, []))
+        print(line.format(key, count, '{:.1f}'.format(count / duration),
+                          *stats, generator.errors.get(key, 0)))
+    if cycles_info:
+        total, late, missed = cycles_info
+        print('Cycles profiled: {}'.format(total))
+        print('Late valve writes: {} {}'.format(len(late), late[:20]))
+        print('Missed revolutions: {} {}'.format(len(missed), missed[:20]))
+
+
+def run(args):
+    """Run the load test, starting a simulated daemon if needed"""
+    daemon, url = None, args.url
+    if not url:
+        command = [sys.executable, '-m', 'rpi2casterd.loadtest', 'serve',
+                   '--port', str(args.port), '--rpm', str(args.rpm)]
+        if args.trace:
+            command.extend(['--trace', args.trace,
+                            '--speed', str(args.speed)])
+        daemon = subprocess.Popen(command)
+        url = 'http://127.0.0.1:{}'.format(args.port)
+    generator = LoadGenerator(url)
+    try:
+        # wait until the daemon is ready
+        deadline = time.monotonic() + 30
+        while generator.request('GET', '/', record=False) is None:
+            if time.monotonic() > deadline:
+                sys.exit('Cannot connect to {}'.format(url))
+            time.sleep(0.2)
+        generator.errors.clear()
+        generator.request('PUT', '/profiler', record=False)
+        duration = generator.run(args.cycles, args.dashboards,
+                                 args.status_interval, args.config_interval)
+        generator.request('DELETE', '/profiler', record=False)
+        cycles_info = None
+        with suppress(urllib.error.URLError, OSError, ValueError):
+            endpoint = '{}/profiler/data'.format(url)
+            with urllib.request.urlopen(endpoint) as response:
+                csv_text = response.read().decode()
+            cycles_info = analyze_cycles(csv_text, args.max_delay / 1000)
+        report(generator, duration, cycles_info)
+    finally:
+        if daemon:
+            daemon.terminate()
+            daemon.wait()
+
+
+def main():
+    """Parse the command line and run the selected command"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    server = commands.add_parser('serve', help='run a simulated daemon')
+    server.add_argument('--port', type=int, default=23017)
+    server.add_argument('--rpm', type=float, default=150,
+                        help='simulated machine speed')
+    server.add_argument('--punching', action='store_true',
+                        help='simulate the punching mode')
+    server.add_argument('--trace', help='replay a recorded sensor trace '
+                        'instead of a steady rotation')
+    server.add_argument('--speed', type=float, default=1,
+                        help='trace replay speed (2 = twice as fast)')
+    server.set_defaults(function=serve)
+    client = commands.add_parser('run', help='run the load test')
+    client.add_argument('--url', help='daemon URL; if not specified, '
+                        'a simulated daemon is started')
+    client.add_argument('--port', type=int, default=23018,
+                        help='port for the simulated daemon')
+    client.add_argument('--rpm', type=float, default=150,
+                        help='simulated machine speed')
+    client.add_argument('--trace', help='simulated daemon: replay '
+                        'a recorded sensor trace')
+    client.add_argument('--speed', type=float, default=1,
+                        help='trace replay speed (2 = twice as fast)')
+    client.add_argument('--cycles', type=int, default=200,
+                        help='number of combinations to cast')
+    client.add_argument('--dashboards', type=int, default=2,
+                        help='number of clients polling the status')
+    client.add_argument('--status-interval', type=float, default=0.5,
+                        help='status polling interval in seconds')
+    client.add_argument('--config-interval', type=float, default=5,
+                        help='/config and /emergency_stop polling interval')
+    client.add_argument('--max-delay', type=float, default=5,
+                        help='valve write delay after the sensor went ON '
+                        'considered as disturbed, in milliseconds')
+    client.set_defaults(function=run)
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,33 @@ It communicates with client(s) via a JSON API and controls the machine
 using selectable backend libraries for greater configurability.
 """
 from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
-from functools import wraps
 import configparser
+import itertools
 import logging
+import multiprocessing
+import os
+import pickle
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 import librpi2caster
-from flask import Flask, abort, jsonify
+from flask import Flask, Response, abort, jsonify
 from flask.globals import request
 from gpiozero import Button, LED, GPIOPinMissing, GPIOPinInUse
+from werkzeug.utils import secure_filename
+
+from rpi2casterd import profiler as prof
+from rpi2casterd.ribbon import Ribbon
+from rpi2casterd.ring import MessageRing
+from rpi2casterd.state import MachineState, dumps
+from rpi2casterd.statusmap import StatusMap
+from rpi2casterd import traces
 
 LOG = logging.getLogger('rpi2casterd')
 DEBUG_MODE = False
@@ -27,20 +41,35 @@ ALL_METHODS = GET, PUT, POST, DELETE = 'GET', 'PUT', 'POST', 'DELETE'
 IN, OUT = ON, OFF = True, False
 OUTPUT_SIGNALS = tuple(['0075', 'S', '0005', *'ABCDEFGHIJKLMN',
                         *(str(x) for x in range(1, 15)), 'O15'])
+# column and row signals for the valve test sweep
+COLUMNS = tuple('ABCDEFGHIJKLMN')
+# two-process mode: how often the state and readings are sent (seconds)
+STATUS_INTERVAL = 0.1
+ROWS = tuple(str(x) for x in range(1, 15))
 
 DEFAULTS = dict(name='Monotype composition caster',
                 listen_address='0.0.0.0:23017', output_driver='smbus',
                 shutdown_gpio='24', shutdown_command='shutdown -h now',
                 reboot_gpio='23', reboot_command='shutdown -r now',
                 startup_timeout='30', sensor_timeout='5',
+                stall_factor='2.5', stall_timeout_min='0.5',
+                stall_timeout_max='5', min_rpm='40', max_rpm='300',
                 punching_on_time='0.2', punching_off_time='0.3',
-                debounce_milliseconds='25',
+                debounce_milliseconds='25', profiler_cycles='1000',
+                pump_stop_cycles='3', pump_stop_timeout='60',
+                status_file='/run/rpi2casterd/status', trace_file='',
+                ribbon_spool_dir='/var/lib/rpi2casterd/ribbons',
+                split_processes='no',
+                counters_file='/var/lib/rpi2casterd/counters.json',
+                counters_flush_interval='300',
                 ready_led_gpio='18', sensor_gpio='17',
                 working_led_gpio='', error_led_gpio='',
                 air_gpio='', water_gpio='', emergency_stop_gpio='',
                 motor_start_gpio='', motor_stop_gpio='',
                 mode_detect_gpio='27',
-                i2c_bus='1', mcp0_address='0x20', mcp1_address='0x21',
+                i2c_bus='1', i2c_device='',
+                mcp0_address='0x20', mcp1_address='0x21',
+                i2c_retries='3', i2c_retry_delay_us='200', i2c_verify='no',
                 valve1='N,M,L,K,J,I,H,G',
                 valve2='F,S,E,D,0075,C,B,A',
                 valve3='1,2,3,4,5,6,7,8',
@@ -126,6 +155,16 @@ def daemon_setup():
     signal.signal(signal.SIGTERM, signal_handler)
 
 
+def address_and_port(input_string):
+    """Get an IP or DNS address and a port"""
+    try:
+        address, _port = input_string.split(':')
+        port = int(_port)
+    except ValueError:
+        address, port = input_string, 23017
+    return address, port
+
+
 def pin(name, direction, **kwargs):
     """Set up an input or output pin"""
     gpio_string = CFG.defaults().get('{}_gpio'.format(name)).strip()
@@ -138,6 +177,16 @@ def pin(name, direction, **kwargs):
 def main():
     """Starts the application. Contains web API subroutines."""
     journald_setup()
+    if CFG.getboolean('DEFAULT', 'split_processes', fallback=False):
+        run_split()
+    else:
+        run_hardware(lambda interface: interface.webapi())
+
+
+def run_hardware(serve):
+    """Initialize the hardware and the interface, then call serve
+    with the interface (until exit), making sure that the GPIOs
+    are cleaned up afterwards."""
     interface = None
     try:
         # initialize hardware
@@ -145,8 +194,8 @@ def main():
         daemon_setup()
         interface = Interface()
         GPIO.ready_led.on()
-        # start the web API for communicating with client
-        interface.webapi()
+        # start communicating with the client(s)
+        serve(interface)
 
     except KeyError as exception:
         raise librpi2caster.ConfigurationError(exception)
@@ -165,21 +214,370 @@ def main():
         # make sure the GPIOs are de-configured properly
         with suppress(AttributeError):
             interface.machine_control(OFF)
+        with suppress(AttributeError):
+            interface.trace_recorder.close()
+        with suppress(AttributeError):
+            interface.stop_flushing.set()
+            interface.save_counters()
         GPIO.cleanup()
 
 
+def run_split():
+    """Two-process mode: the hardware control process owns the Interface,
+    GPIOs and output, while this process runs the web API.
+    The requests and replies are passed through shared memory rings."""
+    def signal_handler(*_):
+        """Exit gracefully if SIGINT or SIGTERM received"""
+        raise KeyboardInterrupt
+
+    requests, replies = MessageRing(), MessageRing()
+    hardware = multiprocessing.Process(target=hardware_process,
+                                       args=(requests.handle, replies.handle),
+                                       name='rpi2casterd-hardware')
+    hardware.start()
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    backend = RemoteInterface(requests, replies, hardware)
+    try:
+        address = CFG.defaults().get('listen_address')
+        webapi(backend, *address_and_port(address))
+    except KeyboardInterrupt:
+        LOG.info('System exit due to ctrl-C keypress.')
+    finally:
+        backend.shutdown()
+        hardware.join(timeout=120)
+        if hardware.is_alive():
+            hardware.terminate()
+        requests.close()
+        replies.close()
+
+
+def hardware_process(requests_handle, replies_handle):
+    """Hardware control process: execute the web API requests
+    from the requests ring, send the outcome to the replies ring.
+    The state (when changed) and readings go with every reply,
+    and every STATUS_INTERVAL seconds, so that the web API process
+    answers the status and metrics requests by itself."""
+    def snapshot():
+        """State (if changed since the last one) and readings"""
+        nonlocal version
+        state = None
+        if interface.status.version != version:
+            version = interface.status.version
+            state = interface.status.as_dict()
+        return state, interface.readings()
+
+    def publish():
+        """Send the state and readings when they change"""
+        last = None
+        while not stopping.wait(STATUS_INTERVAL):
+            with lock:
+                state, readings = snapshot()
+                if state is None and readings == last:
+                    continue
+                replies.put(pickle.dumps((0, None, None, state, readings)))
+            last = readings
+
+    def execute(request_id, endpoint, method, data, device, received):
+        """Handle a single request and send a reply"""
+        try:
+            reply = ('ok', interface.api_request(endpoint, method, data,
+                                                 device=device,
+                                                 received=received))
+        except KeyError as exception:
+            reply = ('not_found', str(exception))
+        except NotImplementedError:
+            reply = ('not_implemented', device)
+        except ValueError as exception:
+            reply = ('bad_request', str(exception))
+        except Exception as exception:  # pylint: disable=broad-except
+            LOG.exception('Error handling %s %s', method, endpoint)
+            reply = ('error', str(exception))
+        with lock:
+            replies.put(pickle.dumps((request_id, *reply, *snapshot())))
+
+    def serve(hardware_interface):
+        """Receive the requests and handle them in worker threads,
+        as the web server would; exit when asked or orphaned."""
+        nonlocal interface
+        interface = hardware_interface
+        publisher = threading.Thread(target=publish, daemon=True)
+        publisher.start()
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                while True:
+                    message = requests.get(timeout=1)
+                    if message is None:
+                        if os.getppid() != parent:
+                            # the web API process is gone
+                            return
+                        continue
+                    request_id, *arguments = pickle.loads(message)
+                    if request_id is None:
+                        return
+                    executor.submit(execute, request_id, *arguments)
+        finally:
+            stopping.set()
+            publisher.join()
+
+    parent, interface, lock = os.getppid(), None, threading.Lock()
+    version, stopping = None, threading.Event()
+    requests = MessageRing(requests_handle)
+    replies = MessageRing(replies_handle)
+    try:
+        run_hardware(serve)
+    finally:
+        requests.close()
+        replies.close()
+
+
+class RemoteInterface:
+    """Web API process side of the two-process mode.
+    Passes the requests to the hardware control process
+    and waits for the replies; keeps a copy of the state
+    and readings sent by the hardware control process."""
+    def __init__(self, requests, replies, process):
+        self.requests, self.replies, self.process = requests, replies, process
+        # Flask threads share the requests ring: one writer at a time
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending = dict()
+        self.status, self._readings = MachineState(), None
+        self.has_readings = threading.Event()
+        listener = threading.Thread(target=self._receive, daemon=True)
+        listener.start()
+
+    def _receive(self):
+        """Get the replies and pass them to the waiting requests,
+        after updating the state (request id 0: state and readings only)"""
+        while True:
+            request_id, kind, value, state, readings = \
+                pickle.loads(self.replies.get())
+            if state is not None:
+                self.status.update(**state)
+            self._readings = readings
+            self.has_readings.set()
+            waiter = self.pending.pop(request_id, None)
+            if waiter:
+                waiter.append((kind, value))
+                waiter[0].set()
+
+    def _wait(self, event):
+        """Wait for the hardware process to set the event"""
+        while not event.wait(1):
+            if not self.process.is_alive():
+                raise RuntimeError('Hardware control process has exited')
+
+    def readings(self):
+        """The last readings from the hardware process"""
+        self._wait(self.has_readings)
+        return self._readings
+
+    def api_request(self, endpoint, method, data, device=None,
+                    received=None):
+        """Pass the request to the hardware process and return
+        the outcome, raising the same exceptions as Interface does."""
+        request_id = next(self.request_ids)
+        waiter = self.pending[request_id] = [threading.Event()]
+        message = pickle.dumps((request_id, endpoint, method, data, device,
+                                received))
+        with self.lock:
+            self.requests.put(message)
+        try:
+            self._wait(waiter[0])
+        except RuntimeError:
+            self.pending.pop(request_id, None)
+            raise
+        kind, value = waiter[1]
+        if kind == 'not_found':
+            raise KeyError(value)
+        if kind == 'not_implemented':
+            raise NotImplementedError
+        if kind == 'bad_request':
+            raise ValueError(value)
+        if kind == 'error':
+            raise RuntimeError(value)
+        return value
+
+    def shutdown(self):
+        """Tell the hardware process to clean up and exit"""
+        with self.lock, suppress(TimeoutError):
+            self.requests.put(pickle.dumps((None,)), timeout=1)
+
+
+def webapi(backend, address, port):
+    """JSON web API for communicating with the casting software.
+    The requests are handled by the backend: the Interface itself,
+    or a RemoteInterface passing them to the hardware control process.
+    The status, metrics and profiler CSV are built here, from the
+    backend's state and readings, so polling them does not load
+    the hardware control process."""
+    def stamp(environ, start_response):
+        """Store the time when the web server passed the request on,
+        before routing and JSON parsing (for the cycle profiler)"""
+        environ['rpi2casterd.received'] = time.monotonic_ns()
+        return wsgi_app(environ, start_response)
+
+    def call(endpoint, data, device=None):
+        """Pass the request to the backend, handle the HTTP errors"""
+        received = request.environ.get('rpi2casterd.received')
+        try:
+            return backend.api_request(endpoint, request.method, data,
+                                       device=device, received=received)
+        except KeyError:
+            abort(404)
+        except NotImplementedError:
+            abort(501)
+        except ValueError:
+            abort(400)
+
+    def request_data():
+        """Get the JSON data sent with a POST or PUT request;
+        PUT without a body (e.g. to turn a device on) has no data.
+        The data must be a JSON object."""
+        if request.method in (POST, PUT) and request.get_data(cache=True):
+            data = request.get_json() or {}
+            if not isinstance(data, dict):
+                abort(400)
+            return data
+        return {}
+
+    def index():
+        """Get or change the interface's current status.
+        The state is serialized only when it has changed;
+        the readings are added."""
+        if request.method in (POST, PUT):
+            call('index', request_data())
+        readings = backend.readings()
+        extras = OrderedDict(success=True)
+        extras.update(speed='{}rpm'.format(readings['speed']),
+                      stall_timeout=readings['stall_timeout'],
+                      **readings['gpio'], **readings['output'])
+        outcome = dumps(extras)[:-1] + b',' + backend.status.to_json()[1:]
+        return Response(outcome, mimetype='application/json')
+
+    def config():
+        """Get or change the interface's configuration"""
+        return jsonify(call('config', request_data()))
+
+    def signals():
+        """Send the signals to the machine or get the current signals"""
+        return jsonify(call('signals', request_data()))
+
+    def ribbon_job():
+        """Ribbon file streaming: the uploaded file (multipart form,
+        field "ribbon") is saved in the spool directory first.
+        Uploads are rejected while a ribbon is streamed."""
+        job_data = dict(request.get_json(silent=True) or request.form)
+        upload = request.files.get('ribbon')
+        if upload:
+            if backend.status.get('ribbon'):
+                busy = librpi2caster.InterfaceBusy()
+                return jsonify(success=False, error_code=busy.code,
+                               error_name=busy.message)
+            spool_dir = CFG.defaults().get('ribbon_spool_dir').strip()
+            os.makedirs(spool_dir, exist_ok=True)
+            path = secure_filename(upload.filename) or 'ribbon.txt'
+            # write a new file and replace the old one: a memory-mapped
+            # ribbon keeps the old file, instead of seeing it truncated
+            descriptor, temporary = tempfile.mkstemp(dir=spool_dir,
+                                                     prefix='.upload-')
+            try:
+                with os.fdopen(descriptor, 'wb') as target:
+                    upload.save(target)
+                os.chmod(temporary, 0o644)
+                os.replace(temporary, os.path.join(spool_dir, path))
+            except OSError:
+                with suppress(OSError):
+                    os.remove(temporary)
+                raise
+            job_data['path'] = path
+        return jsonify(call('ribbon_job', job_data))
+
+    def profiler_data():
+        """Download the cycle profiler data.
+        GET: CSV (default) or binary (?format=binary) dump,
+        DELETE: clear the recorded data."""
+        outcome = call('profiler_data', {})
+        if request.method == DELETE:
+            return Response(status=204)
+        if request.args.get('format') == 'binary':
+            return Response(outcome['data'],
+                            mimetype='application/octet-stream')
+        return Response(prof.csv_dump(outcome['data'], outcome['first']),
+                        mimetype='text/csv')
+
+    def valves_test():
+        """Run a valve sweep or get the last report"""
+        return jsonify(call('valves_test', request_data()))
+
+    def valves_counters():
+        """Get (GET) or reset (DELETE) the valve actuation counters"""
+        if request.method == DELETE:
+            return jsonify(call('valves_counters', {}))
+        return jsonify(success=True, counters=backend.readings()['valves'])
+
+    def metrics():
+        """Counters and measurements in the Prometheus text format"""
+        readings = backend.readings()
+        lines = ['# TYPE rpi2casterd_valve_actuations_total counter']
+        lines.extend('rpi2casterd_valve_actuations_total'
+                     '{{valve="{}"}} {}'.format(name, count)
+                     for name, count in sorted(readings['valves'].items()))
+        lines.extend(['# TYPE rpi2casterd_cycles_total counter',
+                      'rpi2casterd_cycles_total {}'
+                      .format(backend.status['cycles']),
+                      '# TYPE rpi2casterd_speed_rpm gauge',
+                      'rpi2casterd_speed_rpm {}'.format(readings['speed'])])
+        # output error counters, if the output driver provides them
+        for name, count in sorted(readings['output'].items()):
+            lines.extend(['# TYPE rpi2casterd_{}_total counter'.format(name),
+                          'rpi2casterd_{}_total {}'.format(name, count)])
+        return Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain; version=0.0.4')
+
+    def control(device):
+        """Change or check the status of one of the controls"""
+        return jsonify(call('control', request_data(), device))
+
+    app = Flask('rpi2casterd')
+    wsgi_app, app.wsgi_app = app.wsgi_app, stamp
+    app.route('/', methods=ALL_METHODS)(index)
+    app.route('/config', methods=ALL_METHODS)(config)
+    app.route('/signals', methods=ALL_METHODS)(signals)
+    app.route('/profiler/data', methods=(GET, DELETE))(profiler_data)
+    app.route('/ribbon/job', methods=(GET, POST))(ribbon_job)
+    app.route('/valves/test', methods=(GET, POST))(valves_test)
+    app.route('/valves/counters', methods=(GET, DELETE))(valves_counters)
+    app.route('/metrics', methods=(GET,))(metrics)
+    app.route('/<device>', methods=ALL_METHODS)(control)
+    app.run(address, port, debug=DEBUG_MODE)
+
+
 class Interface:
     """Basic data structures of an interface"""
     def __init__(self):
         self.config, self.output = OrderedDict(), None
-        # data structure to count photocell ON events for rpm meter
-        self.meter_events = deque(maxlen=3)
+        # photocell ON event history for rpm meter and rotation checks
+        self.meter_events = deque(maxlen=5)
+        # cycle timing profiler, created when enabled
+        self.profiler = None
+        # memory-mapped status for local readers
+        self.status_map = None
+        # sensor and emergency stop edge capture
+        self.trace_recorder = None
+        # output lock shared by the casting loop and emergency stop;
+        # after the emergency cut-off, valves stay off until stopped
+        self.output_lock = threading.Lock()
+        self.valves_cut_off = False
+        # report of the last valve test sweep
+        self.valves_test_report = dict()
+        # ribbon file streamed from the spool directory
+        self.ribbon, self.ribbon_thread = None, None
+        # valve actuation counters are saved periodically until exit
+        self.stop_flushing = threading.Event()
         # initialize machine state
-        self.status = dict(wedge_0005=15, wedge_0075=15,
-                           valves=OFF, signals=[], testing_mode=False,
-                           is_working=False, motor_working=False,
-                           emergency_stop=False, pump_working=False,
-                           is_stopping=False, is_starting=False)
+        self.status = MachineState()
         self.configure()
         self.hardware_setup()
 
@@ -257,6 +655,10 @@ class Interface:
             raw = [x.strip().upper() for x in input_string.split(',')]
             return [x for x in raw if x in OUTPUT_SIGNALS]
 
+        def boolean(input_string):
+            """Convert yes/no, on/off, true/false, 1/0 to bool"""
+            return CFG.BOOLEAN_STATES.get(input_string.strip().lower(), False)
+
         def integer(input_string):
             """Convert a decimal, octal, binary or hexadecimal string to int"""
             with suppress(TypeError):
@@ -267,29 +669,38 @@ class Interface:
             converts it to a desired data type"""
             return convert(CFG.defaults().get(parameter))
 
-        def address_and_port(input_string):
-            """Get an IP or DNS address and a port"""
-            try:
-                address, _port = input_string.split(':')
-                port = int(_port)
-            except ValueError:
-                address, port = input_string, 23017
-            return address, port
-
         # get timings
         self.config['name'] = get('name', str)
         self.config['address'], self.config['port'] = get('listen_address',
                                                           address_and_port)
         self.config['startup_timeout'] = get('startup_timeout', float)
         self.config['sensor_timeout'] = get('sensor_timeout', float)
+        self.config['stall_factor'] = get('stall_factor', float)
+        self.config['stall_timeout_min'] = get('stall_timeout_min', float)
+        self.config['stall_timeout_max'] = get('stall_timeout_max', float)
+        self.config['min_rpm'] = get('min_rpm', float)
+        self.config['max_rpm'] = get('max_rpm', float)
         self.config['punching_on_time'] = get('punching_on_time', float)
         self.config['punching_off_time'] = get('punching_off_time', float)
+        self.config['pump_stop_cycles'] = get('pump_stop_cycles', integer)
+        self.config['pump_stop_timeout'] = get('pump_stop_timeout', float)
+        self.config['status_file'] = get('status_file').strip()
+        self.config['trace_file'] = get('trace_file').strip()
+        self.config['ribbon_spool_dir'] = get('ribbon_spool_dir').strip()
+        self.config['profiler_cycles'] = get('profiler_cycles', integer)
+        self.config['counters_file'] = get('counters_file').strip()
+        self.config['counters_flush_interval'] = get('counters_flush_interval',
+                                                     float)
 
         # determine the output driver and settings
         self.config['output_driver'] = get('output_driver').lower()
         self.config['i2c_bus'] = get('i2c_bus', integer)
+        self.config['i2c_device'] = get('i2c_device').strip()
         self.config['mcp0_address'] = get('mcp0_address', integer)
         self.config['mcp1_address'] = get('mcp1_address', integer)
+        self.config['i2c_retries'] = get('i2c_retries', integer)
+        self.config['i2c_retry_delay_us'] = get('i2c_retry_delay_us', float)
+        self.config['i2c_verify'] = get('i2c_verify', boolean)
         self.config['signal_mappings'] = dict(valve1=get('valve1', signals),
                                               valve2=get('valve2', signals),
                                               valve3=get('valve3', signals),
@@ -302,19 +713,42 @@ class Interface:
         def update_rpm_meter():
             """Update the RPM event counter"""
             LOG.debug('Photocell sensor activated')
-            if self.motor_working:
-                self.meter_events.append(time.time())
+            self.meter_events.append(time.monotonic())
 
         def update_emergency_stop():
-            """Check and update the emergency stop status"""
+            """Cut off the valves, air and water right away,
+            then update the emergency stop status and stop the machine.
+            The latency is measured from the button edge time
+            reported by the pin driver, including the callback dispatch."""
+            since = time.perf_counter()
+            with suppress(TypeError):
+                since -= GPIO.estop_button.active_time
+            try:
+                self._emergency_cutoff(since=since)
+            except OSError as exception:
+                LOG.error('Cannot turn the valves off: %s', exception)
             LOG.warning('Emergency stop button pressed!')
-            with suppress(librpi2caster.MachineStopped):
+            try:
                 self.emergency_stop_control(ON)
+            except librpi2caster.MachineStopped:
+                pass
+            except OSError as exception:
+                LOG.error('Cannot stop the machine: %s', exception)
 
         # register callbacks
         GPIO.sensor.when_pressed = update_rpm_meter
         GPIO.estop_button.when_pressed = update_emergency_stop
 
+        # capture the sensor and emergency stop edges if configured
+        trace_file = self.config.get('trace_file')
+        if trace_file:
+            LOG.info('Recording sensor and emergency stop edges to %s',
+                     trace_file)
+            self.trace_recorder = traces.TraceRecorder(trace_file)
+            self.trace_recorder.attach(traces.SENSOR, GPIO.sensor)
+            self.trace_recorder.attach(traces.EMERGENCY_STOP,
+                                       GPIO.estop_button)
+
         # does the interface offer the motor start/stop capability?
         motor_feature = GPIO.motor_start and GPIO.motor_stop
         self.config['has_motor_control'] = bool(motor_feature)
@@ -327,8 +761,12 @@ class Interface:
             output_name = self.config.get('output_driver')
             if output_name == 'smbus':
                 from rpi2casterd.smbus import SMBusOutput as output
+            elif output_name == 'i2cdev':
+                from rpi2casterd.i2cdev import I2CDevOutput as output
             elif output_name == 'wiringpi':
                 from rpi2casterd.wiringpi import WiringPiOutput as output
+            elif output_name == 'simulation':
+                from rpi2casterd.simulation import SimulatedOutput as output
             else:
                 raise NameError
             self.output = output(self.config)
@@ -339,69 +777,94 @@ class Interface:
             raise librpi2caster.ConfigurationError('{}: module not installed'
                                                    .format(output_name))
 
-    def webapi(self):
-        """JSON web API for communicating with the casting software."""
-        def handle_request(routine):
-            """Boilerplate code for the flask API functions,
-            used for handling requests to interfaces."""
-            @wraps(routine)
-            def wrapper(*args, **kwargs):
-                """wraps the routine"""
-                response = OrderedDict()
-                try:
-                    # does the function return any json-ready parameters?
-                    outcome = routine(*args, **kwargs) or {}
-                    # if caught no exceptions, all went well => return success
-                    response.update(success=True, **outcome)
-                except KeyError:
-                    abort(404)
-                except NotImplementedError:
-                    abort(501)
-                except (librpi2caster.InterfaceNotStarted,
-                        librpi2caster.InterfaceBusy,
-                        librpi2caster.MachineStopped) as exc:
-                    # HTTP response with an error code
-                    response.update(success=False, error_code=exc.code,
-                                    error_name=exc.message)
-                return jsonify(response)
-
-            return wrapper
-
-        @handle_request
+        # restore the valve actuation counts; count and save them
+        # periodically (even if they are not saved, as the recorded
+        # masks would pile up otherwise)
+        counters_file = self.config.get('counters_file')
+        if counters_file and os.path.exists(counters_file):
+            try:
+                self.output.actuations.load(counters_file)
+            except (OSError, ValueError, AttributeError) as exception:
+                LOG.warning('Cannot load valve counters from %s: %s',
+                            counters_file, exception)
+        flusher = threading.Thread(target=self._flush_counters, daemon=True)
+        flusher.start()
+
+        # shared status segment setup; the daemon can work without it
+        status_file = self.config.get('status_file')
+        if status_file:
+            try:
+                self.status_map = StatusMap(status_file)
+                self._publish_status()
+            except OSError as exception:
+                LOG.warning('Cannot publish status in %s: %s',
+                            status_file, exception)
+
+    def api_request(self, endpoint, method, data, device=None,
+                    received=None):
+        """Handle a web API request, independent of HTTP and Flask,
+        so that it can be passed from another process as well.
+        received: time.monotonic_ns() value when the request came.
+        Return a response dict with success=True and the outcome,
+        or success=False with the error code and name.
+        The status, metrics and profiler CSV responses are built
+        by the web API from the state and readings() instead.
+        Raise KeyError if not found, NotImplementedError if not supported,
+        ValueError if the request data is invalid.
+        """
         def index():
-            """Get or change the interface's current status."""
-            if request.method in (POST, PUT):
-                request_data = request.get_json() or {}
-                self.status.update(**request_data)
-            status = self.status
-            status.update(speed='{}rpm'.format(self._rpm()),
-                          **GPIO.get_values())
-            return status
-
-        @handle_request
+            """Change the interface's current status.
+            Only the client-settable status fields can be changed."""
+            if method in (POST, PUT):
+                self.status.update(**self.status.validate(data))
+
         def config():
             """Get or change the interface's configuration"""
-            if request.method in (POST, PUT):
-                request_data = request.get_json() or {}
-                self.config.update(request_data)
+            if method in (POST, PUT):
+                self.config.update(data)
             return self.config
 
-        @handle_request
         def signals():
             """Sends the signals to the machine.
             GET: gets the current signals,
             PUT/POST: sends the signals to the machine."""
-            if request.method in (POST, PUT):
-                request_data = request.get_json() or dict()
-                codes = request_data.get('signals') or []
-                timeout = request_data.get('timeout')
-                self.send_signals(codes, timeout)
-            elif request.method == DELETE:
+            if method in (POST, PUT):
+                if self.status.get('ribbon'):
+                    raise librpi2caster.InterfaceBusy
+                codes = data.get('signals') or []
+                timeout = data.get('timeout')
+                self.send_signals(codes, timeout, received=received)
+            elif method == DELETE:
                 self.valves_control(OFF)
             return dict(signals=self.signals)
 
-        @handle_request
-        def control(device):
+        def ribbon_job():
+            """Ribbon file streaming.
+            GET: gets the progress,
+            POST: selects a file in the spool directory ({path: name}),
+            and/or moves to a given line ({line: n}).
+            Casting is started (PUT) or paused (DELETE) via /ribbon."""
+            if method == POST:
+                path = data.get('path')
+                if path:
+                    self.ribbon_load(path)
+                line = data.get('line')
+                if line is not None:
+                    self.ribbon_seek(int(line))
+            return {key: value for key, value in self.status.items()
+                    if key.startswith('ribbon')}
+
+        def profiler_data():
+            """Get the cycle profiler data.
+            GET: binary dump and the number of its first cycle,
+            DELETE: clear the recorded data."""
+            profiler = self.profiler or prof.CycleProfiler(1)
+            if method == DELETE:
+                profiler.clear()
+            return dict(first=profiler.cycles - profiler.length,
+                        data=profiler.to_bytes())
+
+        def control():
             """Change or check the status of one of the
             machine/interface's controls:
                 -caster's pump,
@@ -415,31 +878,89 @@ class Interface:
             POST turns on (state=True), off (state=False)
             """
             # find a suitable interface method, otherwise it's not implemented
-            # handle_request will reply 501
+            # the web API will reply 501
             method_name = '{}_control'.format(device)
-            request_data = request.get_json() or {}
-            device_state = request_data.get('state')
+            device_state = data.get('state')
             try:
                 routine = getattr(self, method_name)
             except AttributeError:
                 raise NotImplementedError
             # we're sure that we have a method
-            if request.method == POST and device_state is not None:
+            if method == POST and device_state is not None:
                 routine(bool(device_state))
-            elif request.method == PUT:
+            elif method == PUT:
                 routine(ON)
-            elif request.method == DELETE:
+            elif method == DELETE:
                 routine(OFF)
             # always return the current state of the controlled device
-            return dict(active=self.status.get(device))
+            fields = dict(machine='is_working', motor='motor_working',
+                          pump='pump_working')
+            active = self.status.get(fields.get(device, device))
+            if active is None:
+                active = GPIO.get_values().get(device)
+            return dict(active=active)
+
+        def valves_test():
+            """Valve and solenoid test runner.
+            GET: gets the progress or the last report,
+            POST: starts the test with parameters:
+                mode: single (default), pairs or pattern,
+                pattern: list of combinations (for the pattern mode),
+                on_time, off_time: step timing in seconds,
+                measure: measure the output write time per step."""
+            if method == POST:
+                self.test_valves(mode=data.get('mode', 'single'),
+                                 pattern=data.get('pattern'),
+                                 on_time=data.get('on_time'),
+                                 off_time=data.get('off_time'),
+                                 measure=data.get('measure', False))
+            # the report is updated by the test thread: take a snapshot
+            report = dict(self.valves_test_report)
+            if 'steps' in report:
+                report['steps'] = list(report['steps'])
+            return report
+
+        def valves_counters():
+            """Valve actuation counters.
+            GET: gets the counts by signal name (plus air and water),
+            DELETE: resets all counts to zero."""
+            if method == DELETE:
+                self.output.actuations.reset()
+                self.save_counters()
+            return dict(counters=self.output.actuations.get())
+
+        routines = dict(index=index, config=config, signals=signals,
+                        ribbon_job=ribbon_job, profiler_data=profiler_data,
+                        valves_test=valves_test,
+                        valves_counters=valves_counters, control=control)
+        routine = routines[endpoint]
+        response = OrderedDict()
+        try:
+            # does the function return any json-ready parameters?
+            outcome = routine() or {}
+            # if caught no exceptions, all went well => return success
+            response.update(success=True, **outcome)
+        except (librpi2caster.InterfaceNotStarted,
+                librpi2caster.InterfaceBusy,
+                librpi2caster.MachineStopped) as exc:
+            # HTTP response with an error code
+            response.update(success=False, error_code=exc.code,
+                            error_name=exc.message)
+        return response
 
-        app = Flask('rpi2casterd')
-        app.route('/', methods=ALL_METHODS)(index)
-        app.route('/config', methods=ALL_METHODS)(config)
-        app.route('/signals', methods=ALL_METHODS)(signals)
-        app.route('/<device>', methods=ALL_METHODS)(control)
-        app.run(self.config.get('address'), self.config.get('port'),
-                debug=DEBUG_MODE)
+    def webapi(self):
+        """JSON web API for communicating with the casting software."""
+        webapi(self, self.config.get('address'), self.config.get('port'))
+
+    def readings(self):
+        """Measurements and counters which are not in the state:
+        speed, stall timeout, GPIO values, output error counters
+        (if the output driver provides them), valve actuation counts"""
+        return dict(speed=self._rpm(),
+                    stall_timeout=round(self._stall_timeout(), 3),
+                    gpio=GPIO.get_values(),
+                    output=dict(getattr(self.output, 'counters', {})),
+                    valves=self.output.actuations.get())
 
     def _wait_for_sensor(self, new_state, timeout=0):
         """Wait until the machine cycle sensor changes its state
@@ -468,15 +989,16 @@ class Interface:
 
     def _rpm(self):
         """Speed meter for rpi2casterd"""
-        events = self.meter_events
+        events = tuple(self.meter_events)
         sensor_timeout = self.config.get('sensor_timeout', 5)
         try:
             # how long in seconds is it from the first to last event?
             duration = events[-1] - events[0]
-            if not duration or duration > sensor_timeout:
+            stale = time.monotonic() - events[-1] > sensor_timeout
+            if not duration or duration > sensor_timeout or stale:
                 # single event or waited too long
                 return 0
-            # 3 timestamps = 2 rotations
+            # n timestamps = n-1 rotations
             per_second = (len(events) - 1) / duration
             rpm = round(per_second * 60, 2)
             return rpm
@@ -484,6 +1006,70 @@ class Interface:
             # not enough events / measurement points
             return 0
 
+    def _machine_rotating(self):
+        """Check the photocell event history. Return True if the machine
+        has just completed several regular cycles at a speed between
+        min_rpm and max_rpm, so there is no need to wait for the sensor."""
+        events = tuple(self.meter_events)
+        if len(events) < 3:
+            return False
+        period = (events[-1] - events[0]) / (len(events) - 1)
+        if not period:
+            return False
+        # the last cycle must be recent and all cycles roughly even
+        fresh = time.monotonic() - events[-1] < 2 * period
+        even = all(0.5 * period < later - earlier < 1.5 * period
+                   for earlier, later in zip(events, events[1:]))
+        rpm = 60 / period
+        sane = (self.config.get('min_rpm', 0) <= rpm <=
+                self.config.get('max_rpm', 300))
+        return fresh and even and sane
+
+    def _publish_status(self):
+        """Update the memory-mapped status for local readers"""
+        if self.status_map:
+            self.status_map.publish(self.status, self._rpm(),
+                                    self.status['cycles'])
+
+    def _flush_counters(self):
+        """Count the recorded valve masks and save the counters
+        every few minutes, so that not every cycle costs a file write"""
+        interval = self.config.get('counters_flush_interval') or 300
+        while not self.stop_flushing.wait(interval):
+            with suppress(AttributeError):
+                self.output.actuations.fold()
+            self.save_counters()
+
+    def save_counters(self):
+        """Save the valve actuation counters in the counters file"""
+        counters_file = self.config.get('counters_file')
+        if not counters_file:
+            return
+        try:
+            self.output.actuations.save(counters_file)
+        except (OSError, AttributeError) as exception:
+            LOG.warning('Cannot save valve counters in %s: %s',
+                        counters_file, exception)
+
+    def _stall_timeout(self):
+        """Adaptive machine stall detection threshold.
+        Use stall_factor times the rolling cycle period measured
+        by the photocell, limited by stall_timeout_min and _max.
+        Fall back to sensor_timeout if the detector is disabled
+        (stall_factor=0) or there is no fresh speed measurement."""
+        sensor_timeout = self.config.get('sensor_timeout', 5)
+        factor = self.config.get('stall_factor')
+        events = tuple(self.meter_events)
+        if not factor or len(events) < 2:
+            return sensor_timeout
+        if time.monotonic() - events[-1] > sensor_timeout:
+            # the last measurement is stale
+            return sensor_timeout
+        period = (events[-1] - events[0]) / (len(events) - 1)
+        floor = self.config.get('stall_timeout_min', 0)
+        ceiling = self.config.get('stall_timeout_max', sensor_timeout)
+        return min(max(factor * period, floor), ceiling)
+
     def _update_pump_and_wedges(self):
         """Check the wedge positions and return them."""
         def found(code):
@@ -536,6 +1122,8 @@ class Interface:
             msg = 'Cannot start the machine while emergency stop is in action!'
             LOG.warning(msg)
             raise librpi2caster.MachineStopped(msg)
+        # the emergency stop is not active: the valves can work again
+        self._restore_valves()
 
         # continue with the start sequence
         LOG.info('Starting the machine...')
@@ -548,14 +1136,19 @@ class Interface:
             # if MachineStopped is raised, it'll bubble up from here
             self.water_control(ON)
             self.motor_control(ON)
-            # check machine rotation
-            timeout = self.config.get('startup_timeout', 5)
-            for _ in range(3):
-                self._wait_for_sensor(ON, timeout=timeout)
-                self._wait_for_sensor(OFF, timeout=timeout)
+            # check machine rotation; if it has been turning already,
+            # the speed meter history is enough to prove it
+            if self._machine_rotating():
+                LOG.info('Machine rotation confirmed by the speed meter.')
+            else:
+                timeout = self.config.get('startup_timeout', 5)
+                for _ in range(3):
+                    self._wait_for_sensor(ON, timeout=timeout)
+                    self._wait_for_sensor(OFF, timeout=timeout)
         LOG.info('Machine started.')
         self.status.update(is_starting=False)
         GPIO.error_led.value = OFF
+        self._publish_status()
 
     def _stop(self):
         """Stop the machine, making sure that the pump is disengaged."""
@@ -569,6 +1162,10 @@ class Interface:
             self.status.update(is_stopping=True, is_starting=False)
             # always turn off the red/green/orange LED
             GPIO.error_led.value, GPIO.working_led.value = OFF, OFF
+            # after the emergency cut-off, the valves and air
+            # are needed again for the pump stop sequence
+            if self._restore_valves() and self.pump_working:
+                self.air_control(ON)
             # stop the pump first
             self._pump_stop()
             LOG.debug('Checking if the machine is working...')
@@ -588,11 +1185,18 @@ class Interface:
             # release the interface so others can claim it
             self.status.update(is_working=False, is_stopping=False,
                                testing_mode=False)
+            self._publish_status()
+            with suppress(AttributeError):
+                self.trace_recorder.flush()
         except librpi2caster.MachineStopped:
             # if emergency stop happens, repeat recursively
             # reset the stopping flag
             self.status.update(is_stopping=False)
             self._stop()
+        except OSError:
+            # output error: the stop can be requested again
+            self.status.update(is_stopping=False)
+            raise
 
     def _pump_start(self):
         """Start the pump."""
@@ -607,11 +1211,20 @@ class Interface:
 
     def _pump_stop(self):
         """Stop the pump if it is working.
-        This function will send the pump stop combination (NJS 0005) twice
-        to make sure that the pump is turned off.
-        In case of failure, repeat."""
-        def stop_sequence():
+        This function will send the pump stop combination (NJS 0005)
+        for pump_stop_cycles machine cycles to make sure that the pump
+        is turned off. When casting, the valves are switched on sensor
+        edge events. If this is not finished before pump_stop_timeout,
+        the pump stop is marked as failed and the pump stays working,
+        so that the next stop will try again."""
+        def remaining():
+            """Time left until the deadline"""
+            return max(deadline - time.monotonic(), 0)
+
+        def stop_cycle():
             """send signals depending on casting/punching mode"""
+            if not remaining():
+                raise TimeoutError
             # don't change the current 0005 wedge position
             wedge_0005 = self.status['wedge_0005']
             self.signals = 'NJS0005{}'.format(wedge_0005)
@@ -624,33 +1237,44 @@ class Interface:
                 self.valves_control(OFF)
                 time.sleep(self.config['punching_off_time'])
             else:
-                while GPIO.sensor.value != ON:
-                    time.sleep(0.05)
+                if not GPIO.sensor.wait_for_press(timeout=remaining()):
+                    raise TimeoutError
                 self.valves_control(ON)
-                while GPIO.sensor.value != OFF:
-                    time.sleep(0.05)
-                self.valves_control(OFF)
+                try:
+                    if not GPIO.sensor.wait_for_release(timeout=remaining()):
+                        raise TimeoutError
+                finally:
+                    self.valves_control(OFF)
 
         # do this only in the casting and punching modes
         if self.testing_mode or not self.pump_working:
             return
 
         LOG.info('Stopping the pump...')
+        cycles = self.config.get('pump_stop_cycles', 3)
+        deadline = time.monotonic() + self.config.get('pump_stop_timeout', 60)
+        self.status.update(pump_stop_done=0, pump_stop_needed=cycles,
+                           pump_stop_failed=False)
         # store previous LED states; light the red error LED only
         error_led = GPIO.error_led.value
         working_led = GPIO.working_led.value
         GPIO.error_led.value, GPIO.working_led.value = ON, OFF
-        with suppress(librpi2caster.MachineStopped, KeyboardInterrupt):
-            # send three combinations to be sure
-            stop_sequence()
-            stop_sequence()
-            stop_sequence()
+        try:
+            for done in range(1, cycles + 1):
+                stop_cycle()
+                self.status.update(pump_stop_done=done)
             self._update_pump_and_wedges()
+        except (TimeoutError, librpi2caster.MachineStopped,
+                KeyboardInterrupt):
+            # leave the red LED on to alert the operator
+            self.status.update(pump_stop_failed=True)
+            LOG.error('Pump stop failed after %s of %s cycles.',
+                      self.status['pump_stop_done'], cycles)
+            GPIO.working_led.value = working_led
+            return
         # finished; reset LEDs
         GPIO.error_led.value = error_led
         GPIO.working_led.value = working_led
-        # repeat recursively in case stop was unsuccessful
-        self._pump_stop()
         LOG.info('Pump successfully stopped.')
 
     def _check_emergency_stop(self):
@@ -662,9 +1286,43 @@ class Interface:
             self._stop()
             raise librpi2caster.MachineStopped
 
+    def _emergency_cutoff(self, since=None):
+        """Emergency stop fast path: turn all valves off and cut the air
+        and water supply immediately. Hold the output lock so that
+        the casting loop cannot turn the valves on until the machine
+        is stopped. Store the latency (since the given perf_counter value
+        or the call) in milliseconds.
+        Air and water are plain GPIO writes, so they go first: the valve
+        output can fail (raising OSError) if the I2C bus is faulty."""
+        start = since or time.perf_counter()
+        with self.output_lock:
+            self.valves_cut_off = True
+            with suppress(AttributeError):
+                GPIO.air.value = OFF
+            with suppress(AttributeError):
+                GPIO.water.value = OFF
+            try:
+                self.output.valves_off()
+                self.status.update(valves=OFF)
+            finally:
+                latency = round((time.perf_counter() - start) * 1000, 3)
+                self.status.update(emergency_stop_latency=latency)
+
+    def _restore_valves(self):
+        """Allow turning the valves on again after the emergency cut-off.
+        Return True if they were cut off."""
+        with self.output_lock:
+            was_cut_off, self.valves_cut_off = self.valves_cut_off, False
+        return was_cut_off
+
     def emergency_stop_control(self, state):
         """Emergency stop: state=ON to activate, OFF to clear"""
+        if state and not self.valves_cut_off:
+            self._emergency_cutoff()
+        elif not state:
+            self._restore_valves()
         self.status.update(emergency_stop=state)
+        self._publish_status()
         msg = 'Emergency stop {}'.format('activated!' if state else 'cleared.')
         LOG.warning(msg)
         self._check_emergency_stop()
@@ -684,17 +1342,24 @@ class Interface:
 
     def valves_control(self, state):
         """Turn valves on or off, check valve status.
-        Accepts signals (turn on), False (turn off) or None (get the status)"""
+        Accepts signals (turn on), False (turn off) or None (get the status).
+        Raise MachineStopped if the valves were cut off by emergency stop."""
         if state:
             # got the signals
             message = 'Valves on: {}'.format(' '.join(self.signals))
             LOG.debug(message)
-            self.output.valves_on(self.signals)
-            self.status.update(valves=ON)
+            with self.output_lock:
+                if self.valves_cut_off:
+                    LOG.warning('Valves cut off by emergency stop.')
+                    raise librpi2caster.MachineStopped
+                self.output.valves_on(self.signals)
+                self.status.update(valves=ON)
         else:
             LOG.debug('Turning all valves off.')
-            self.output.valves_off()
-            self.status.update(valves=OFF)
+            with self.output_lock:
+                self.output.valves_off()
+                self.status.update(valves=OFF)
+        self._publish_status()
 
     def motor_control(self, state):
         """Motor control:
@@ -709,10 +1374,9 @@ class Interface:
             time.sleep(0.2)
             output.off()
         self.status.update(motor_working=new_state)
-        self.meter_events.clear()
+        self._publish_status()
 
-    @staticmethod
-    def air_control(state):
+    def air_control(self, state):
         """Air supply control: master compressed air solenoid valve.
         no state or None = get the air state,
         anything evaluating to True or False = turn on or off"""
@@ -720,10 +1384,12 @@ class Interface:
                    .format('ON' if state else 'OFF'))
         LOG.info(message)
         with suppress(AttributeError):
+            actuated = state and not GPIO.air.value
             GPIO.air.value = state
+            if actuated:
+                self.output.actuations.count('air')
 
-    @staticmethod
-    def water_control(state):
+    def water_control(self, state):
         """Cooling water control:
         no state or None = get the water valve state,
         anything evaluating to True or False = turn on or off"""
@@ -731,7 +1397,106 @@ class Interface:
                    .format('ON' if state else 'OFF'))
         LOG.info(message)
         with suppress(AttributeError):
+            actuated = state and not GPIO.water.value
             GPIO.water.value = state
+            if actuated:
+                self.output.actuations.count('water')
+
+    def test_valves(self, mode='single', pattern=None,
+                    on_time=None, off_time=None, measure=False):
+        """Sweep the valves in the testing mode, without the client:
+            single: every signal one by one,
+            pairs: every column with every row,
+            pattern: a list of combinations given by the user.
+        Optionally measure the output write time for every step.
+        The sweep runs in a background thread; the progress and results
+        are stored in self.valves_test_report.
+        Raise ValueError if the parameters are invalid, InterfaceBusy
+        if the interface is already working (even in the testing mode)."""
+        if mode == 'single':
+            combinations = [[signal] for signal in OUTPUT_SIGNALS]
+        elif mode == 'pairs':
+            combinations = [[column, row]
+                            for column in COLUMNS for row in ROWS]
+        elif mode == 'pattern' and pattern:
+            combinations = [parse_signals(item) for item in pattern]
+        else:
+            raise ValueError('Unknown test mode or empty pattern')
+        if on_time is None:
+            on_time = self.config.get('punching_on_time', 0.2)
+        if off_time is None:
+            off_time = self.config.get('punching_off_time', 0.3)
+        try:
+            on_time, off_time = float(on_time), float(off_time)
+        except TypeError as exception:
+            raise ValueError(str(exception))
+        if not 0 <= on_time < 60 or not 0 <= off_time < 60:
+            raise ValueError('Step times must be between 0 and 60 seconds')
+        if self.is_working or self.is_starting:
+            raise librpi2caster.InterfaceBusy
+
+        LOG.info('Testing the valves: %s, %s steps', mode, len(combinations))
+        testing_mode = self.testing_mode
+        self.status.update(testing_mode=True)
+        try:
+            self._start()
+        except librpi2caster.InterfaceBusy:
+            # someone else has just started the machine
+            self.status.update(testing_mode=testing_mode)
+            raise
+        self.valves_test_report = dict(mode=mode, state='running', steps=[],
+                                       completed=0, total=len(combinations),
+                                       on_time=on_time, off_time=off_time)
+        thread = threading.Thread(target=self._valves_test_job,
+                                  args=(combinations, measure), daemon=True)
+        thread.start()
+
+    def _valves_test_job(self, combinations, measure):
+        """Send the test combinations until finished, or until
+        the machine is stopped; update the report on every step."""
+        report = self.valves_test_report
+        on_time, off_time = report['on_time'], report['off_time']
+        steps, start_time = report['steps'], time.monotonic()
+        try:
+            for combination in combinations:
+                if not self.is_working:
+                    # stopped with a client request
+                    raise librpi2caster.MachineStopped
+                self._check_emergency_stop()
+                self.signals = combination
+                step = dict(signals=' '.join(self.signals))
+                if measure:
+                    with self.output_lock:
+                        if self.valves_cut_off:
+                            raise librpi2caster.MachineStopped
+                        write_start = time.perf_counter()
+                        self.output.valves_on(self.signals)
+                        write_time = time.perf_counter() - write_start
+                    self.status.update(valves=ON)
+                    step.update(write_us=round(write_time * 1e6, 1))
+                else:
+                    self.valves_control(ON)
+                steps.append(step)
+                report['completed'] = len(steps)
+                time.sleep(on_time)
+                self.valves_control(OFF)
+                time.sleep(off_time)
+            report['state'] = 'finished'
+            LOG.info('Valve test finished.')
+        except Exception as exception:  # pylint: disable=broad-except
+            report['state'] = 'stopped'
+            LOG.error('Valve test stopped after %s steps: %s',
+                      len(steps), exception)
+        finally:
+            report['duration'] = round(time.monotonic() - start_time, 3)
+            write_times = [step['write_us'] for step in steps
+                           if 'write_us' in step]
+            if write_times:
+                report.update(write_us_min=min(write_times),
+                              write_us_max=max(write_times),
+                              write_us_avg=round(sum(write_times) /
+                                                 len(write_times), 1))
+            self._stop()
 
     def pump_control(self, state):
         """No state: get the pump status.
@@ -742,7 +1507,108 @@ class Interface:
         else:
             self._pump_stop()
 
-    def send_signals(self, signals, timeout=None):
+    def ribbon_load(self, path):
+        """Open a ribbon file in the spool directory.
+        Raise KeyError if it does not exist or is outside the spool."""
+        if self.status.get('ribbon'):
+            raise librpi2caster.InterfaceBusy
+        spool_dir = os.path.realpath(self.config.get('ribbon_spool_dir'))
+        file_path = os.path.realpath(os.path.join(spool_dir, path))
+        if os.path.commonpath([spool_dir, file_path]) != spool_dir:
+            raise KeyError(path)
+        try:
+            ribbon = Ribbon(file_path)
+        except OSError:
+            raise KeyError(path)
+        with suppress(AttributeError):
+            self.ribbon.close()
+        self.ribbon = ribbon
+        LOG.info('Ribbon file loaded: %s', file_path)
+        self.status.update(ribbon_state='loaded', ribbon_line=1,
+                           ribbon_file=os.path.relpath(file_path, spool_dir),
+                           ribbon_progress=0)
+
+    def ribbon_seek(self, line):
+        """Move to a given line of the ribbon file (not while running)"""
+        if self.status.get('ribbon'):
+            raise librpi2caster.InterfaceBusy
+        if not self.ribbon:
+            raise KeyError('ribbon')
+        self.ribbon.seek(line)
+        self.status.update(ribbon_line=self.ribbon.line,
+                           ribbon_progress=self.ribbon.progress)
+
+    def ribbon_control(self, state):
+        """Ribbon streaming: state=ON to start or resume, OFF to pause
+        after the current combination."""
+        if not state:
+            if self.status.get('ribbon'):
+                LOG.info('Pausing the ribbon...')
+                self.status.update(ribbon=False, ribbon_state='paused')
+            return
+        if not self.ribbon:
+            raise KeyError('ribbon')
+        if self.ribbon_thread and self.ribbon_thread.is_alive():
+            if self.status.get('ribbon'):
+                return
+            # still pausing; wait until the current combination is sent
+            self.ribbon_thread.join()
+        self.status.update(ribbon=True, ribbon_state='running')
+        self.ribbon_thread = threading.Thread(target=self._ribbon_job,
+                                              daemon=True)
+        self.ribbon_thread.start()
+
+    def _ribbon_job(self):
+        """Send the combinations from the ribbon file until it ends,
+        the job is paused or the machine is stopped."""
+        ribbon = self.ribbon
+        LOG.info('Streaming the ribbon from line %s', ribbon.line)
+        try:
+            casting = not self.punch_mode and not self.testing_mode
+            if casting and not self.is_working:
+                self._start()
+            for _, combination in ribbon.combinations():
+                if not self.status.get('ribbon'):
+                    # paused: this combination will be sent after resuming
+                    ribbon.rewind()
+                    return
+                try:
+                    self.send_signals(combination)
+                except Exception:
+                    # send this combination again after resuming
+                    ribbon.rewind()
+                    raise
+                self.status.update(ribbon_line=ribbon.line,
+                                   ribbon_progress=ribbon.progress)
+            LOG.info('Ribbon finished.')
+            self.status.update(ribbon=False, ribbon_state='finished')
+            self._stop()
+        except (librpi2caster.MachineStopped,
+                librpi2caster.InterfaceNotStarted,
+                librpi2caster.InterfaceBusy) as exception:
+            LOG.error('Ribbon stopped at line %s: %s', ribbon.line, exception)
+            self.status.update(ribbon=False, ribbon_state='stopped')
+        except Exception:  # pylint: disable=broad-except
+            # e.g. output driver errors: don't leave the ribbon running
+            LOG.exception('Ribbon stopped at line %s', ribbon.line)
+            self.status.update(ribbon=False, ribbon_state='stopped')
+        finally:
+            self.status.update(ribbon_line=ribbon.line,
+                               ribbon_progress=ribbon.progress)
+
+    def profiler_control(self, state):
+        """Cycle timing profiler: state=ON to start recording,
+        OFF to stop. Recorded data is kept until the profiler
+        is started again."""
+        if state:
+            size = self.config.get('profiler_cycles') or 1000
+            self.profiler = prof.CycleProfiler(size)
+        message = ('Cycle timing profiler {}'
+                   .format('started' if state else 'stopped'))
+        LOG.info(message)
+        self.status.update(profiler=bool(state))
+
+    def send_signals(self, signals, timeout=None, received=None):
         """Send the signals to the caster/perforator.
         This method performs a single-dispatch on current operation mode:
             casting: sensor ON, valves ON, sensor OFF, valves OFF;
@@ -751,7 +1617,10 @@ class Interface:
 
         In the punching mode, if there are less than two signals,
         an additional O+15 signal will be activated. Otherwise the paper ribbon
-        advance mechanism won't work."""
+        advance mechanism won't work.
+
+        received: time.monotonic_ns() value when the web server got
+        the request, stored by the cycle profiler."""
         def cast():
             """Monotype composition caster.
 
@@ -761,13 +1630,22 @@ class Interface:
             # the interface must be started beforehand if we want to cast
             if not self.is_working:
                 raise librpi2caster.InterfaceNotStarted
-            # allow the use of a custom timeout
-            wait = timeout or self.config['sensor_timeout']
+            # allow the use of a custom timeout,
+            # otherwise derive it from the machine speed
+            wait = timeout or self._stall_timeout()
             # machine control cycle
             self._wait_for_sensor(ON, timeout=wait)
+            if profiler:
+                profiler.mark(prof.SENSOR_ON)
             self.valves_control(ON)
+            if profiler:
+                profiler.mark(prof.VALVES_ON)
             self._wait_for_sensor(OFF, timeout=wait)
+            if profiler:
+                profiler.mark(prof.SENSOR_OFF)
             self.valves_control(OFF)
+            if profiler:
+                profiler.mark(prof.VALVES_OFF)
             self._update_pump_and_wedges()
 
         def test():
@@ -777,6 +1655,8 @@ class Interface:
             # change the active combination
             self.valves_control(OFF)
             self.valves_control(ON)
+            if profiler:
+                profiler.mark(prof.VALVES_ON)
 
         def punch():
             """Timer-driven ribbon perforator."""
@@ -784,16 +1664,30 @@ class Interface:
                 self._start()
             # timer-driven operation
             self.valves_control(ON)
+            if profiler:
+                profiler.mark(prof.VALVES_ON)
             time.sleep(self.config['punching_on_time'])
             self.valves_control(OFF)
+            if profiler:
+                profiler.mark(prof.VALVES_OFF)
             time.sleep(self.config['punching_off_time'])
             self._update_pump_and_wedges()
 
+        # profiler is None when disabled, so it costs nothing
+        profiler = self.profiler if self.status['profiler'] else None
+        if profiler:
+            profiler.begin(received)
         self.signals = signals
+        if profiler:
+            profiler.mark(prof.PARSED)
         rtn = test if self.testing_mode else punch if self.punch_mode else cast
         # catch emergency stop button/key events
         self._check_emergency_stop()
         rtn()
+        self.status['cycles'] += 1
+        if profiler:
+            profiler.mark(prof.UPDATED)
+        self._publish_status()
         self._check_emergency_stop()
 
 
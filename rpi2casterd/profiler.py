@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Cycle timing profiler for rpi2casterd.
+
+Records monotonic timestamps (in nanoseconds) of every phase
+of a machine cycle into a preallocated ring buffer."""
+
+from array import array
+import time
+
+PHASES = ('request', 'parsed', 'sensor_on', 'valves_on',
+          'sensor_off', 'valves_off', 'updated')
+REQUEST, PARSED, SENSOR_ON, VALVES_ON, SENSOR_OFF, VALVES_OFF, UPDATED = \
+    range(len(PHASES))
+
+
+def csv_dump(data, first=0):
+    """CSV with a header row, from the binary dump (see to_bytes);
+    first: number of the first cycle in the dump"""
+    values, width = array('Q', data), len(PHASES)
+    lines = [','.join(('cycle', *PHASES))]
+    for number, offset in enumerate(range(0, len(values), width), first):
+        row = values[offset:offset + width]
+        lines.append(','.join(str(x) for x in (number, *row)))
+    return '\n'.join(lines) + '\n'
+
+
+class CycleProfiler:
+    """Ring buffer of per-phase cycle timestamps.
+    Each cycle takes one row of len(PHASES) unsigned 64-bit integers;
+    phases not applicable for the current mode (e.g. sensor events
+    when punching) are left at zero."""
+    def __init__(self, size=1000):
+        self.size = max(int(size), 1)
+        self.width = len(PHASES)
+        self.buffer = array('Q', bytes(8 * self.width * self.size))
+        self.cycles, self.offset = 0, 0
+
+    @property
+    def length(self):
+        """Number of cycles currently stored in the buffer"""
+        return min(self.cycles, self.size)
+
+    def begin(self, received=None):
+        """Start a new cycle row and store the request timestamp
+        (time.monotonic_ns() value when received, or now)"""
+        self.offset = (self.cycles % self.size) * self.width
+        self.cycles += 1
+        buffer, offset = self.buffer, self.offset
+        buffer[offset] = received or time.monotonic_ns()
+        for phase in range(1, self.width):
+            buffer[offset + phase] = 0
+
+    def mark(self, phase):
+        """Store the timestamp for a given phase of the current cycle"""
+        self.buffer[self.offset + phase] = time.monotonic_ns()
+
+    def clear(self):
+        """Reset the profiler"""
+        self.cycles, self.offset = 0, 0
+
+    def rows(self):
+        """Cycle numbers and timestamps, oldest first"""
+        first = self.cycles - self.length
+        for number in range(first, self.cycles):
+            offset = (number % self.size) * self.width
+            yield number, self.buffer[offset:offset + self.width]
+
+    def to_bytes(self):
+        """Compact binary dump: native-endian uint64 values,
+        len(PHASES) per cycle, oldest cycle first"""
+        return b''.join(row.tobytes() for _, row in self.rows())
+
+    def to_csv(self):
+        """CSV dump with a header row"""
+        return csv_dump(self.to_bytes(), self.cycles - self.length)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Ribbon file reader for rpi2casterd.
+
+Reads the ribbon file through a memory map and yields the combinations
+lazily, one line at a time, so that the memory use does not depend
+on the file size. The file must be in the casting order.
+Empty lines, comments (starting with #, // or ;) and metadata lines
+(e.g. "title: ...") are skipped. Line numbers start at 1."""
+
+import mmap
+
+COMMENTS = (b'#', b'//', b';')
+# keep the offset of every n-th line for faster seeking
+CHECKPOINT_EVERY = 1024
+
+
+class Ribbon:
+    """Memory-mapped ribbon file with a line cursor"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as ribbon_file:
+            try:
+                self.map = mmap.mmap(ribbon_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file cannot be mapped
+                self.map = b''
+        self.size = len(self.map)
+        # line number and offset of the next line to read
+        self.line, self.offset = 1, 0
+        # line number and offset of the line read most recently
+        self.current = (1, 0)
+        # offsets of lines 1, 1+CHECKPOINT_EVERY, 1+2*CHECKPOINT_EVERY...
+        self.checkpoints = [0]
+
+    @property
+    def progress(self):
+        """How much of the file was read, in percent"""
+        return round(100 * self.offset / self.size, 2) if self.size else 100
+
+    def _next_line(self):
+        """Read a line at the cursor and advance, or return None at EOF"""
+        if self.offset >= self.size:
+            return None
+        end = self.map.find(b'\n', self.offset)
+        end = self.size if end < 0 else end
+        text = self.map[self.offset:end]
+        self.current = (self.line, self.offset)
+        self.line, self.offset = self.line + 1, min(end + 1, self.size)
+        if not (self.line - 1) % CHECKPOINT_EVERY:
+            index = (self.line - 1) // CHECKPOINT_EVERY
+            if index == len(self.checkpoints):
+                self.checkpoints.append(self.offset)
+        return text
+
+    def seek(self, line):
+        """Move the cursor to the beginning of a given line"""
+        line = max(int(line), 1)
+        index = min((line - 1) // CHECKPOINT_EVERY, len(self.checkpoints) - 1)
+        self.line = index * CHECKPOINT_EVERY + 1
+        self.offset = self.checkpoints[index]
+        while self.line < line and self._next_line() is not None:
+            pass
+
+    def rewind(self):
+        """Move the cursor back to the line read most recently"""
+        self.line, self.offset = self.current
+
+    def combinations(self):
+        """Generate (line number, combination string) from the cursor
+        onwards, skipping the lines with no combinations"""
+        while True:
+            text = self._next_line()
+            if text is None:
+                return
+            text = text.strip()
+            if not text or text.startswith(COMMENTS) or b':' in text:
+                continue
+            yield self.current[0], text.decode('ascii', 'ignore')
+
+    def close(self):
+        """Unmap the file"""
+        if self.size:
+            self.map.close()
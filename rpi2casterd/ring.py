@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Shared memory message ring for rpi2casterd.
+
+A single-producer, single-consumer ring buffer in a
+multiprocessing.shared_memory block, used for passing the commands
+and replies between the web API and hardware control processes.
+The producer only moves the head counter, the consumer only moves
+the tail counter; the messages are copied without any lock held.
+
+Layout (little-endian):
+    uint32  head: total number of bytes written (modulo 2**32)
+    uint32  tail: total number of bytes read (modulo 2**32)
+    bytes   data: messages, each prefixed with its uint32 length,
+            wrapping around at the end of the data area.
+
+Memory ordering: the counters are only read and written with a shared
+lock held, and every published message is signalled with a semaphore.
+Both are POSIX semaphores, whose operations are full memory barriers
+(POSIX.1 "Memory Synchronization"), so the other process cannot see
+the new head before the message data, or the new tail before
+the message was read out - also on weakly ordered CPUs (ARM).
+If the process writing into the ring is multi-threaded,
+the threads must use a lock of their own."""
+
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import struct
+import time
+
+COUNTERS = struct.Struct('<II')
+LENGTH = struct.Struct('<I')
+HEAD, TAIL = 0, 4
+WRAP = 1 << 32
+
+
+class MessageRing:
+    """Shared memory ring for variable-length byte messages.
+    Create a new ring, or attach to an existing one with the handle
+    of the ring, passed to the other process when starting it."""
+    def __init__(self, handle=None, capacity=1 << 20):
+        if handle is None:
+            # the counters wrap at 2**32, so the capacity must divide it
+            if capacity & (capacity - 1) or capacity >= WRAP:
+                raise ValueError('Ring capacity must be a power of 2')
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=COUNTERS.size + capacity)
+            COUNTERS.pack_into(self.shm.buf, 0, 0, 0)
+            self.lock = multiprocessing.Lock()
+            self.messages = multiprocessing.Semaphore(0)
+            self.owner = True
+        else:
+            name, capacity, self.lock, self.messages = handle
+            self.shm = shared_memory.SharedMemory(name=name)
+            # attaching registers the segment with the resource tracker,
+            # which would report it as leaked (or even remove it)
+            # when this process exits; only the owner tracks it
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.owner = False
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.data = self.shm.buf[COUNTERS.size:COUNTERS.size + capacity]
+
+    @property
+    def handle(self):
+        """Data needed to attach to the ring in another process"""
+        return self.name, self.capacity, self.lock, self.messages
+
+    def _counter(self, offset):
+        """Read the head or tail counter"""
+        with self.lock:
+            return LENGTH.unpack_from(self.shm.buf, offset)[0]
+
+    def _set_counter(self, offset, value):
+        """Publish the new head or tail counter value"""
+        with self.lock:
+            LENGTH.pack_into(self.shm.buf, offset, value % WRAP)
+
+    def _copy_in(self, position, payload):
+        """Copy bytes into the data area, wrapping around at the end"""
+        start = position % self.capacity
+        first = min(len(payload), self.capacity - start)
+        self.data[start:start + first] = payload[:first]
+        self.data[:len(payload) - first] = payload[first:]
+
+    def _copy_out(self, position, length):
+        """Copy bytes from the data area, wrapping around at the end"""
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        return (bytes(self.data[start:start + first]) +
+                bytes(self.data[:length - first]))
+
+    @staticmethod
+    def _wait(delay):
+        """Sleep for a while, longer with each call (up to 1ms)"""
+        time.sleep(delay)
+        return min(delay * 2 or 2e-5, 1e-3)
+
+    def put(self, message, timeout=None):
+        """Write a message; wait until there is enough free space.
+        Raise TimeoutError if that takes longer than timeout seconds."""
+        needed = LENGTH.size + len(message)
+        if needed > self.capacity:
+            raise ValueError('Message too long for the ring')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        head, delay = self._counter(HEAD), 0
+        while (head - self._counter(TAIL)) % WRAP > self.capacity - needed:
+            if deadline and time.monotonic() > deadline:
+                raise TimeoutError
+            delay = self._wait(delay)
+        self._copy_in(head, LENGTH.pack(len(message)))
+        self._copy_in(head + LENGTH.size, message)
+        # publish the message only after it has been written
+        self._set_counter(HEAD, head + needed)
+        self.messages.release()
+
+    def get(self, timeout=None):
+        """Read a message; wait until there is one.
+        Return None if nothing arrived in timeout seconds."""
+        if not self.messages.acquire(timeout=timeout):
+            return None
+        tail = self._counter(TAIL)
+        length, = LENGTH.unpack(self._copy_out(tail, LENGTH.size))
+        message = self._copy_out(tail + LENGTH.size, length)
+        self._set_counter(TAIL, tail + LENGTH.size + length)
+        return message
+
+    def close(self):
+        """Detach from the shared memory; remove it if created here"""
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            # the tracker is shared with the attached processes, which
+            # unregistered the segment; register it again, so that
+            # unlinking does not unregister an unknown name
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Simulated output backend for rpi2casterd.
+
+Does not control any hardware; the current valve state is only
+stored in memory. Useful for testing and load simulation."""
+
+from functools import reduce
+
+from rpi2casterd.counters import ValveCounters
+
+
+class SimulatedOutput:
+    """Output controller without any hardware."""
+    name = 'Simulated output'
+
+    def __init__(self, config):
+        # map signals to outputs
+        signal_mappings = config['signal_mappings']
+        valve1, valve2 = signal_mappings['valve1'], signal_mappings['valve2']
+        valve3, valve4 = signal_mappings['valve3'], signal_mappings['valve4']
+        signals = [*valve1, *valve2, *valve3, *valve4]
+        signal_numbers = [2 ** x for x in range(32)]
+        self.mapping = dict(zip(signals, signal_numbers))
+        # per-valve actuation counters
+        self.actuations = ValveCounters(signals)
+        self.state = 0
+
+    def __str__(self):
+        return self.name
+
+    def valves_on(self, signals):
+        """Get the signals, transform them to numeric value and store it"""
+        assignment = (self.mapping.get(sig, 0) for sig in signals)
+        self.state = reduce(lambda x, y: x | y, assignment, 0)
+        self.actuations.add(self.state)
+
+    def valves_off(self):
+        """Turn off all the valves"""
+        self.state = 0
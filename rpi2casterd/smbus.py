@@ -2,6 +2,9 @@
 """SMBus backend for rpi2casterd"""
 
 from functools import reduce
+import logging
+import time
+
 try:
     # smbus-cffi
     from smbus import SMBus
@@ -9,6 +12,9 @@ except ImportError:
     # smbus2
     from smbus2 import SMBus
 
+from rpi2casterd.counters import ValveCounters
+
+LOG = logging.getLogger('rpi2casterd')
 # Output latch registers for SMBus MCP23017 control
 OLATA, OLATB = 0x14, 0x15
 # Port direction registers for SMBus MCP23017 control
@@ -22,11 +28,15 @@ class SMBusOutput:
     def __init__(self, config):
         self.mcp0_address = config['mcp0_address']
         self.mcp1_address = config['mcp1_address']
+        # I2C error recovery: retry budget, backoff and read-back
+        self.retries = config.get('i2c_retries', 3)
+        self.retry_delay = config.get('i2c_retry_delay_us', 200) / 1e6
+        self.verify = config.get('i2c_verify', False)
+        self.counters = dict(i2c_retry_count=0, i2c_failures=0,
+                             i2c_reinits=0)
         self.port = SMBus(config['i2c_bus'])
         # initialize pins as outputs with low initial state
-        for address in self.mcp0_address, self.mcp1_address:
-            for register in IODIRA, IODIRB, OLATA, OLATB:
-                self.port.write_byte_data(address, register, 0x00)
+        self._initialize()
         # map signals to outputs
         signal_mappings = config['signal_mappings']
         valve1, valve2 = signal_mappings['valve1'], signal_mappings['valve2']
@@ -34,17 +44,86 @@ class SMBusOutput:
         signals = [*valve1, *valve2, *valve3, *valve4]
         signal_numbers = [2 ** x for x in range(32)]
         self.mapping = dict(zip(signals, signal_numbers))
+        # per-valve actuation counters
+        self.actuations = ValveCounters(signals)
 
     def __str__(self):
         return self.name
 
+    def _initialize(self):
+        """Set all MCP23017 ports as outputs and clear the latches"""
+        for address in self.mcp0_address, self.mcp1_address:
+            for register in IODIRA, IODIRB, OLATA, OLATB:
+                self._write(address, register, 0x00, verify=False)
+
+    def _chips_reset(self):
+        """Check if both chips still have their ports set as outputs.
+        After a brown-out the MCP23017 resets IODIR to 0xff (all inputs),
+        while the output latches can still be written and read back.
+        If that happened, initialize both chips again and return True."""
+        for address in self.mcp0_address, self.mcp1_address:
+            directions = (self._read(address, IODIRA),
+                          self._read(address, IODIRB))
+            if any(directions):
+                LOG.warning('MCP23017 at 0x%02x was reset, '
+                            're-initializing...', address)
+                self.counters['i2c_reinits'] += 1
+                self._initialize()
+                return True
+        return False
+
+    def _retry(self, transfer, address, register):
+        """Call transfer() until it succeeds, retrying on I2C errors
+        with an exponential backoff, and return its result.
+        Raise OSError if the retry budget is exhausted."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.counters['i2c_retry_count'] += 1
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                return transfer()
+            except OSError as exception:
+                error = exception
+                LOG.debug('I2C error at 0x%02x, register 0x%02x: %s',
+                          address, register, exception)
+        self.counters['i2c_failures'] += 1
+        LOG.error('I2C transfer failed after %d retries: %s',
+                  self.retries, error)
+        raise error
+
+    def _read(self, address, register):
+        """Read a byte from the register, retrying on I2C errors"""
+        return self._retry(lambda: self.port.read_byte_data(address, register),
+                           address, register)
+
+    def _write(self, address, register, value, verify=None):
+        """Write a byte to the register, retrying on I2C errors.
+        If verification is enabled, read the register back
+        and compare the value; a mismatch is retried as well."""
+        def transfer():
+            """Write the value, then check it if needed"""
+            self.port.write_byte_data(address, register, value)
+            if verify and self.port.read_byte_data(address, register) != value:
+                raise OSError('Read-back mismatch at 0x{:02x}, '
+                              'register 0x{:02x}'.format(address, register))
+
+        verify = self.verify if verify is None else verify
+        self._retry(transfer, address, register)
+
     def _send(self, byte0, byte1, byte2, byte3):
         """Write 4 bytes of data to all ports (A, B)
-        on all devices (0, 1)"""
-        self.port.write_byte_data(self.mcp0_address, OLATA, byte3)
-        self.port.write_byte_data(self.mcp0_address, OLATB, byte2)
-        self.port.write_byte_data(self.mcp1_address, OLATA, byte1)
-        self.port.write_byte_data(self.mcp1_address, OLATB, byte0)
+        on all devices (0, 1). If verification is enabled, check
+        the port directions afterwards; re-initializing the chips clears
+        all latches, so the whole combination is written again."""
+        for _ in range(self.retries + 1):
+            self._write(self.mcp0_address, OLATA, byte3)
+            self._write(self.mcp0_address, OLATB, byte2)
+            self._write(self.mcp1_address, OLATA, byte1)
+            self._write(self.mcp1_address, OLATB, byte0)
+            if not self.verify or not self._chips_reset():
+                return
+        self.counters['i2c_failures'] += 1
+        raise OSError('MCP23017 keeps resetting, giving up')
 
     def valves_on(self, signals):
         """Get the signals, transform them to numeric value and send
@@ -58,9 +137,10 @@ class SMBusOutput:
             byte2 = (number >> 8) & 0xff
             byte3 = number & 0xff
         else:
-            byte0 = byte1 = byte2 = byte3 = 0x00
+            number = byte0 = byte1 = byte2 = byte3 = 0x00
 
         self._send(byte0, byte1, byte2, byte3)
+        self.actuations.add(number)
 
     def valves_off(self):
         """Turn off all the valves"""
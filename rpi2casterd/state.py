@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Machine state model for rpi2casterd.
+
+A fixed set of typed fields in a __slots__ object, with a version counter
+incremented on every change, and a cached JSON representation
+rebuilt only after the state has changed."""
+
+from collections import OrderedDict
+from contextlib import suppress
+try:
+    # faster JSON encoder, if available
+    import orjson
+
+    def dumps(data):
+        """Serialize data to JSON bytes"""
+        return orjson.dumps(data)
+
+except ImportError:
+    import json
+
+    def dumps(data):
+        """Serialize data to JSON bytes"""
+        return json.dumps(data, separators=(',', ':')).encode()
+
+
+BOOLEANS = dict(true=True, yes=True, on=True, false=False, no=False, off=False)
+
+
+def wedge_position(value):
+    """Justifying wedge position: integer (or digit string) 1...15"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('Invalid wedge position: {!r}'.format(value))
+    if not 1 <= value <= 15:
+        raise ValueError('Wedge position must be between 1 and 15')
+    return value
+
+
+def boolean(value):
+    """Strict boolean: True/False, 1/0 or true/false, yes/no, on/off"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        with suppress(KeyError):
+            return BOOLEANS[value.strip().lower()]
+    raise ValueError('Invalid boolean value: {!r}'.format(value))
+
+
+def signal_list(value):
+    """List of signal names"""
+    if isinstance(value, str):
+        raise ValueError('Signals must be a list')
+    return [str(signal) for signal in value]
+
+
+# field name: (converter for client-supplied values, default value)
+FIELDS = OrderedDict(
+    wedge_0005=(wedge_position, 15), wedge_0075=(wedge_position, 15),
+    valves=(boolean, False), signals=(signal_list, []),
+    testing_mode=(boolean, False), is_working=(boolean, False),
+    motor_working=(boolean, False), emergency_stop=(boolean, False),
+    pump_working=(boolean, False), is_stopping=(boolean, False),
+    is_starting=(boolean, False), pump_stop_done=(int, 0),
+    pump_stop_needed=(int, 0), pump_stop_failed=(boolean, False),
+    profiler=(boolean, False), emergency_stop_latency=(float, 0),
+    cycles=(int, 0), ribbon=(boolean, False), ribbon_state=(str, 'idle'),
+    ribbon_file=(str, ''), ribbon_line=(int, 0), ribbon_progress=(float, 0))
+# the fields clients can change; the rest is controlled by the interface
+CLIENT_FIELDS = ('testing_mode', 'wedge_0005', 'wedge_0075')
+
+
+class MachineState:
+    """Machine and interface state with a fixed set of fields.
+    Behaves like a dict for reading and updating the fields;
+    the values set internally are trusted, the values from the clients
+    are filtered, converted and validated with validate()."""
+    __slots__ = (*FIELDS, 'version', '_json', '_json_version')
+
+    def __init__(self):
+        for name, (_, default) in FIELDS.items():
+            setattr(self, name, list(default) if name == 'signals'
+                    else default)
+        self.version, self._json, self._json_version = 0, b'{}', -1
+
+    def __getitem__(self, name):
+        if name not in FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        self.update(**{name: value})
+
+    def __contains__(self, name):
+        return name in FIELDS
+
+    def get(self, name, default=None):
+        """Get a field value, or the default for unknown fields"""
+        if name not in FIELDS:
+            return default
+        return getattr(self, name)
+
+    def items(self):
+        """Field names and values"""
+        return ((name, getattr(self, name)) for name in FIELDS)
+
+    def update(self, **changes):
+        """Change the fields, bump the version if anything changed"""
+        changed = False
+        for name, value in changes.items():
+            if name not in FIELDS:
+                raise KeyError(name)
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+        if changed:
+            self.version += 1
+
+    @staticmethod
+    def validate(data):
+        """Convert and validate the client-supplied values;
+        ignore the fields which cannot be changed by the clients.
+        Raise ValueError if invalid."""
+        if not isinstance(data, dict):
+            raise ValueError('The status must be a JSON object')
+        try:
+            return {name: FIELDS[name][0](value)
+                    for name, value in data.items()
+                    if name in CLIENT_FIELDS}
+        except TypeError as exception:
+            raise ValueError(str(exception))
+
+    def as_dict(self):
+        """Get the state as an ordered dict"""
+        return OrderedDict(self.items())
+
+    def to_json(self):
+        """Get the state serialized to JSON bytes;
+        serialize again only if it changed since the last call"""
+        if self._json_version != self.version:
+            version = self.version
+            self._json = dumps(self.as_dict())
+            self._json_version = version
+        return self._json
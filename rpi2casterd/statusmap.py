@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped machine status for local readers.
+
+The daemon publishes the machine state into a small fixed-layout file
+(typically /run/rpi2casterd/status), so that local programs can read it
+without going through the web API. The layout (little-endian, no padding):
+
+    offset  type     field
+    0       char[4]  magic: b'R2CS'
+    4       uint32   sequence: odd while the daemon is writing
+    8       uint32   signals mask: bit n set if SIGNALS[n] is active
+    12      uint8    0075 wedge position
+    13      uint8    0005 wedge position
+    14      uint16   flags: see FLAGS, bit n set if FLAGS[n] is true
+    16      float32  machine speed [rpm]
+    20      uint64   cycle counter
+    28      uint64   last update timestamp (CLOCK_MONOTONIC, nanoseconds)
+
+The sequence works as a seqlock: a reader reads the sequence,
+the data twice and the sequence again; if both sequence values
+are equal and even, and both copies of the data are the same,
+the data is consistent. Otherwise the reader retries, until a timeout:
+if the daemon died while writing, the sequence stays odd
+and the status is unavailable.
+
+Memory ordering: Python has no memory fences, so the sequence and
+data are written and read with plain stores and loads. On x86 the
+stores are seen in program order, and the seqlock is exact. On weakly
+ordered CPUs (ARM, e.g. the Raspberry Pi) another core can see the
+stores in a different order; reading the data twice makes it very
+unlikely that a torn update is accepted, as it must then be seen
+the same way twice, but it is not a guarantee. The status is meant
+for displays; anything that must be exact (e.g. machine control)
+should use the web API.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'R2CS'
+LAYOUT = struct.Struct('<4sIIBBHfQQ')
+SEQUENCE = struct.Struct('<I')
+DATA = struct.Struct('<IBBHfQQ')
+SEQUENCE_OFFSET, DATA_OFFSET = 4, 8
+# same order as OUTPUT_SIGNALS in rpi2casterd.main
+SIGNALS = ('0075', 'S', '0005', *'ABCDEFGHIJKLMN',
+           *(str(x) for x in range(1, 15)), 'O15')
+SIGNAL_BITS = {signal: 1 << number for number, signal in enumerate(SIGNALS)}
+FLAGS = ('is_working', 'is_starting', 'is_stopping', 'valves',
+         'pump_working', 'motor_working', 'emergency_stop', 'testing_mode')
+
+
+class StatusMap:
+    """Writer side of the shared status segment"""
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, LAYOUT.size)
+            self.map = mmap.mmap(fd, LAYOUT.size)
+        finally:
+            os.close(fd)
+        self.sequence = 0
+        self.lock = threading.Lock()
+        LAYOUT.pack_into(self.map, 0, MAGIC, 0, 0, 15, 15, 0, 0, 0, 0)
+
+    def publish(self, status, rpm, cycles):
+        """Write the current state from the interface's status dict"""
+        mask = 0
+        for signal in status.get('signals') or ():
+            mask |= SIGNAL_BITS.get(signal, 0)
+        flags = 0
+        for number, name in enumerate(FLAGS):
+            if status.get(name):
+                flags |= 1 << number
+        with self.lock:
+            self.sequence += 1
+            SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+            DATA.pack_into(self.map, DATA_OFFSET, mask,
+                           status.get('wedge_0075', 15),
+                           status.get('wedge_0005', 15),
+                           flags, rpm, cycles, time.monotonic_ns())
+            self.sequence += 1
+            SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        """Unmap the file"""
+        self.map.close()
+
+
+class StatusReader:
+    """Reader side of the shared status segment, for local programs"""
+    def __init__(self, path='/run/rpi2casterd/status'):
+        with open(path, 'rb') as status_file:
+            self.map = mmap.mmap(status_file.fileno(), LAYOUT.size,
+                                 access=mmap.ACCESS_READ)
+        if self.map[:4] != MAGIC:
+            raise ValueError('{} is not a rpi2casterd status file'
+                             .format(path))
+
+    def read(self, timeout=0.1):
+        """Get a consistent raw snapshot:
+        (mask, wedge_0075, wedge_0005, flags, rpm, cycles, timestamp).
+        Raise TimeoutError if there is none in timeout seconds
+        (the daemon was stopped in the middle of writing)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            before, = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)
+            if not before % 2:
+                data = DATA.unpack_from(self.map, DATA_OFFSET)
+                again = DATA.unpack_from(self.map, DATA_OFFSET)
+                after, = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)
+                if before == after and data == again:
+                    return data
+            if time.monotonic() > deadline:
+                raise TimeoutError('Status unavailable: the daemon '
+                                   'has not finished writing it')
+            # let the writer finish
+            time.sleep(0)
+
+    def snapshot(self, timeout=0.1):
+        """Get a consistent snapshot as a dict; age is the time
+        in seconds since the daemon updated the status.
+        Raise TimeoutError if the status is unavailable."""
+        raw = self.read(timeout)
+        mask, wedge_0075, wedge_0005, flags, rpm, cycles, stamp = raw
+        state = {name: bool(flags & 1 << number)
+                 for number, name in enumerate(FLAGS)}
+        state.update(signals=[s for s in SIGNALS if mask & SIGNAL_BITS[s]],
+                     wedge_0075=wedge_0075, wedge_0005=wedge_0005,
+                     speed=round(rpm, 2), cycles=cycles, updated=stamp,
+                     age=round((time.monotonic_ns() - stamp) / 1e9, 3))
+        return state
+
+    def close(self):
+        """Unmap the file"""
+        self.map.close()
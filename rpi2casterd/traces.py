@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Recording and replaying of input edge traces for rpi2casterd.
+
+Sensor and emergency stop edges are stored in a compact binary file:
+a 4-byte magic (b'R2CT'), then 10-byte little-endian records of:
+    uint64  timestamp (CLOCK_MONOTONIC, nanoseconds)
+    uint8   channel (SENSOR=0, EMERGENCY_STOP=1, SESSION=2)
+    uint8   state (1=active, 0=inactive; always 0 for SESSION)
+
+Every daemon run appends to the same file, starting with a SESSION
+record. The monotonic clock starts again after a reboot, and the time
+between the runs is not machine timing, so the timestamps are only
+compared within a session. Files without the SESSION records are split
+where the timestamps go backwards.
+
+The traces can be fed back into gpiozero mock pins (e.g. with
+GPIOZERO_PIN_FACTORY=mock) at the real or accelerated speed,
+for benchmarking and regression testing of the casting loop.
+"""
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'R2CT'
+RECORD = struct.Struct('<QBB')
+CHANNELS = SENSOR, EMERGENCY_STOP, SESSION = 0, 1, 2
+
+
+class TraceRecorder:
+    """Append input edges to a trace file, in a new session"""
+    def __init__(self, path):
+        is_new = not os.path.exists(path) or not os.path.getsize(path)
+        self.file = open(path, 'ab')
+        if is_new:
+            self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.record(SESSION, False)
+
+    def record(self, channel, state, timestamp=None):
+        """Store an edge with the given or current timestamp"""
+        timestamp = timestamp or time.monotonic_ns()
+        entry = RECORD.pack(timestamp, channel, bool(state))
+        with self.lock:
+            self.file.write(entry)
+
+    def attach(self, channel, device):
+        """Record the edges of a gpiozero input device,
+        keeping its current callbacks. The callbacks are called first,
+        so that recording does not delay e.g. the emergency stop."""
+        def pressed():
+            """Call the previous callback, then record the rising edge"""
+            timestamp = time.monotonic_ns()
+            try:
+                if on_press:
+                    on_press()
+            finally:
+                self.record(channel, True, timestamp)
+
+        def released():
+            """Call the previous callback, then record the falling edge"""
+            timestamp = time.monotonic_ns()
+            try:
+                if on_release:
+                    on_release()
+            finally:
+                self.record(channel, False, timestamp)
+
+        on_press, on_release = device.when_pressed, device.when_released
+        device.when_pressed, device.when_released = pressed, released
+
+    def flush(self):
+        """Write the buffered records to disk"""
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        """Flush and close the trace file"""
+        with self.lock:
+            self.file.close()
+
+
+def read_trace(path):
+    """Read a trace file, return a list of (timestamp, channel, state)"""
+    with open(path, 'rb') as trace_file:
+        content = trace_file.read()
+    if content[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a rpi2casterd trace file'.format(path))
+    payload = content[len(MAGIC):]
+    # ignore an incomplete record at the end, if any
+    payload = payload[:len(payload) - len(payload) % RECORD.size]
+    return [(stamp, channel, bool(state))
+            for stamp, channel, state in RECORD.iter_unpack(payload)]
+
+
+def split_sessions(events):
+    """Split the read_trace events into a list of sessions
+    (lists of edges), at the SESSION records and wherever
+    the timestamps go backwards; leave out the empty sessions"""
+    sessions, current, last = [], [], 0
+    for stamp, channel, state in events:
+        if channel == SESSION or stamp < last:
+            if current:
+                sessions.append(current)
+            current = []
+        if channel != SESSION:
+            current.append((stamp, channel, state))
+        last = stamp
+    if current:
+        sessions.append(current)
+    return sessions
+
+
+class TracePlayer:
+    """Replay a trace into gpiozero mock pins in a background thread.
+    pins: dict of channel: pin (supporting drive_high and drive_low),
+    speed: time scale (1 = real time, 2 = twice as fast etc.),
+    loop: start again after the trace has finished.
+    The sessions are replayed one after another, without the gaps."""
+    def __init__(self, path, pins, speed=1.0, loop=False):
+        self.sessions = split_sessions(read_trace(path))
+        self.pins, self.speed, self.loop = pins, speed, loop
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Start replaying in the background"""
+        self.thread.start()
+
+    def stop(self):
+        """Stop replaying"""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        """Replay the trace, keeping the original timing"""
+        while self.sessions and not self.stopped.is_set():
+            for events in self.sessions:
+                if not self.replay(events):
+                    return
+            if not self.loop:
+                return
+
+    def replay(self, events):
+        """Replay a single session; return False if stopped"""
+        first = events[0][0]
+        start = time.monotonic()
+        for stamp, channel, state in events:
+            target = start + (stamp - first) / 1e9 / self.speed
+            if self.stopped.wait(max(target - time.monotonic(), 0)):
+                return False
+            pin = self.pins.get(channel)
+            if pin is None:
+                continue
+            if state:
+                pin.drive_high()
+            else:
+                pin.drive_low()
+        return True
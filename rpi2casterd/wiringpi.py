@@ -3,6 +3,8 @@
 
 import wiringpi
 
+from rpi2casterd.counters import ValveCounters
+
 
 class WiringPiOutput:
     """A 32-channel control interface based on two MCP23017 chips"""
@@ -20,6 +22,10 @@ class WiringPiOutput:
         valve3, valve4 = signal_mappings['valve3'], signal_mappings['valve4']
         signals = [*valve1, *valve2, *valve3, *valve4]
         self.mapping = dict(zip(signals, signal_numbers))
+        # per-valve actuation counters use a 32-bit mask:
+        # bit number = pin number - first pin
+        self.first_pin = self.pin_base
+        self.actuations = ValveCounters(signals)
         # update the pin base for possible additional interfaces
         WiringPiOutput.pin_base += 32
         # Set all I/O lines on MCP23017s as outputs - mode=1
@@ -31,11 +37,14 @@ class WiringPiOutput:
 
     def valves_on(self, signals):
         """Looks a signal up in arrangement and turns it on"""
+        mask = 0
         for sig in signals:
             pin_number = self.mapping.get(sig)
             if not pin_number:
                 continue
             wiringpi.digitalWrite(pin_number, 1)
+            mask |= 1 << (pin_number - self.first_pin)
+        self.actuations.add(mask)
 
     def valves_off(self):
         """Looks a signal up in arrangement and turns it off"""
@@ -27,5 +27,7 @@ setup(name='rpi2casterd', version=__version__,
                    'Programming Language :: Python :: 3 :: Only',
                    'Framework :: Flask'],
       install_requires=__dependencies__, zip_safe=True,
-      entry_points={'console_scripts': ['rpi2casterd = rpi2casterd.main:main']}
+      entry_points={'console_scripts': [
+          'rpi2casterd = rpi2casterd.main:main',
+          'rpi2casterd-loadtest = rpi2casterd.loadtest:main']}
       )